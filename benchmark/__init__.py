@@ -0,0 +1,9 @@
+#coding=utf-8
+"""
+benchmarks of the CMDB API, each module is runnable with python -m benchmark.<module>
+
+    generator           deterministic synthetic graphs, loaded into neo4j
+    scenarios           list / detail / neighbours / writes / traversal / impact load
+    compare             diff of two reports, fails on a regression
+    async_vs_threaded   the asyncio API against the Flask one
+"""
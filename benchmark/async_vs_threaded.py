@@ -0,0 +1,58 @@
+#coding=utf-8
+"""
+latency of a node summary (the node and all its secondary relations)
+on the Flask threaded server against the asyncio server (cmdb_async)
+
+both clients do one GET /v1/<resource>/<id>/summary: the Flask view runs the
+node and relation queries one after the other in a worker thread, cmdb_async
+runs the same queries concurrently.
+
+    python cmdb_view.py &
+    hypercorn --bind 0.0.0.0:5001 cmdb_async:app &
+    python -m benchmark.async_vs_threaded --resource environment --id <environment_id>
+"""
+
+import argparse
+import json
+import sys
+import urllib.error
+import urllib.request
+
+from benchmark.report import dump, measure
+
+
+def fetch(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def summary(base, resource, node_id):
+    fetch("%s/v1/%s/%s/summary" % (base, resource, node_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threaded", default="http://localhost:5000", help="Flask threaded server")
+    parser.add_argument("--async", dest="async_", default="http://localhost:5001", help="cmdb_async server")
+    parser.add_argument("--resource", default="environment")
+    parser.add_argument("--id", required=True, help="id of the node to summarize")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    results = {"scenario": "summary", "resource": args.resource, "concurrency": args.concurrency}
+    for name, base in (("threaded", args.threaded), ("async", args.async_)):
+        try:
+            summary(base, args.resource, args.id)  # warm up
+        except urllib.error.HTTPError as e:
+            sys.stderr.write("%s server: GET %s/v1/%s/%s/summary answered %d\n"
+                             % (name, base, args.resource, args.id, e.code))
+            return 1
+        results[name] = measure(lambda i: summary(base, args.resource, args.id), args.requests, args.concurrency)
+    dump(results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
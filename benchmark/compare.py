@@ -0,0 +1,79 @@
+#coding=utf-8
+"""
+compare two benchmark reports (benchmark.scenarios, benchmark.async_vs_threaded)
+
+    python -m benchmark.compare before.json after.json [--max-regression 10]
+
+prints the change of throughput and latency percentiles per scenario, in %,
+and exits with 1 when a p99 grew or a throughput dropped by more than
+--max-regression percent (MAX_REGRESSION by default).
+"""
+
+import argparse
+import json
+import sys
+from collections import OrderedDict
+
+METRICS = ("throughput_rps", "p50_ms", "p90_ms", "p99_ms")
+
+MAX_REGRESSION = 10.0  # percent
+
+
+def _change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return round((after - before) * 100.0 / before, 2)
+
+
+def _scenarios(report):
+    if "scenarios" in report:
+        return report["scenarios"]
+    # async_vs_threaded: one summary per server
+    return {name: value for name, value in report.items() if isinstance(value, dict)}
+
+
+def compare(before, after):
+    """ {scenario: {metric: {"before", "after", "change_pct"}}} of the scenarios run in both """
+    before, after = _scenarios(before), _scenarios(after)
+    result = OrderedDict()
+    for name, summary in after.items():
+        if name not in before or "skipped" in summary or "skipped" in before[name]:
+            continue
+        result[name] = OrderedDict(
+            (metric, {"before": before[name].get(metric), "after": summary.get(metric),
+                      "change_pct": _change(before[name].get(metric), summary.get(metric))})
+            for metric in METRICS)
+    return result
+
+
+def regressions(changes, threshold):
+    found = []
+    for name, metrics in changes.items():
+        p99, throughput = metrics["p99_ms"]["change_pct"], metrics["throughput_rps"]["change_pct"]
+        if p99 is not None and p99 > threshold:
+            found.append("%s: p99 +%.1f%%" % (name, p99))
+        if throughput is not None and throughput < -threshold:
+            found.append("%s: throughput %.1f%%" % (name, throughput))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--max-regression", type=float, default=MAX_REGRESSION,
+                        help="percent, fail above it (default %(default)s)")
+    args = parser.parse_args()
+
+    with open(args.before) as before, open(args.after) as after:
+        changes = compare(json.load(before), json.load(after))
+    print(json.dumps(changes, indent=2))
+
+    found = regressions(changes, args.max_regression)
+    for line in found:
+        sys.stderr.write("regression %s\n" % line)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#coding=utf-8
+"""
+latency / throughput summaries, printed as JSON so that runs can be compared
+"""
+
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, pct):
+    """ nearest-rank percentile of a sorted list """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """ summary of the latencies (seconds) of a run that took elapsed seconds """
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+    }
+
+
+def measure(call, requests, concurrency):
+    """ run call(i) requests times from concurrency threads, summary of the latencies """
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            call(i)
+        except Exception:
+            with lock:
+                errors[0] += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+
+def dump(results, path=None):
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if path:
+        with open(path, "w") as output:
+            output.write(text + "\n")
+    print(text)
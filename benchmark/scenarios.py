@@ -0,0 +1,176 @@
+#coding=utf-8
+"""
+load scenarios against the API, over a synthetic graph (benchmark.generator)
+
+    list        GET /v1/host?skip=&limit=50
+    detail      GET /v1/app/<id>?include=host,databaseconnect
+    neighbours  GET /v1/app/<id>/host
+    writes      POST /v1/host
+    traversal   GET /v1/app/<id>/dependencies?depth=4
+    impact      GET /v1/host/<id>/impact?depth=3&count=1
+
+backends:
+    http        a running API (--url) over a neo4j loaded with
+                python -m benchmark.generator --size <size> --load
+    inprocess   the Flask app in this process, over the neo4j of DB_URL (same data)
+    snapshot    the Flask app in this process over an in-memory snapshot of the
+                generated graph (cmdb_snapshot), no neo4j needed; only the
+                neighbours, traversal and impact scenarios run
+
+the report (JSON, see benchmark.report) holds throughput and p50/p90/p99 per
+scenario; compare two reports with python -m benchmark.compare.
+
+    python -m benchmark.scenarios --backend snapshot --size 10k --output before.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from benchmark.generator import SIZES, Graph
+from benchmark.report import dump, measure
+
+SCENARIOS = OrderedDict([
+    ("list", lambda graph, rng: ("GET", "/v1/host?skip=%d&limit=50" % rng.randrange(
+        max(1, graph.counts["Host"] - 50)), None)),
+    ("detail", lambda graph, rng: ("GET", "/v1/app/%s?include=host,databaseconnect"
+                                   % graph.sample("App", rng), None)),
+    ("neighbours", lambda graph, rng: ("GET", "/v1/app/%s/host" % graph.sample("App", rng), None)),
+    ("writes", lambda graph, rng: ("POST", "/v1/host", {
+        "host_name": "bench-%08x" % rng.getrandbits(32),
+        "private_ip": "172.16.%d.%d" % (rng.randrange(256), rng.randrange(256))})),
+    ("traversal", lambda graph, rng: ("GET", "/v1/app/%s/dependencies?depth=4" % graph.sample("App", rng), None)),
+    ("impact", lambda graph, rng: ("GET", "/v1/host/%s/impact?depth=3&count=1" % graph.sample("Host", rng), None)),
+])
+
+SNAPSHOT_SCENARIOS = ("neighbours", "traversal", "impact")
+
+
+class HttpTarget(object):
+    """ a running API, one keep-alive connection per thread """
+
+    def __init__(self, url, headers):
+        url = urlparse(url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.headers = headers
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        if not hasattr(self.local, "connection"):
+            self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = dict(self.headers, **({"Content-Type": "application/json"} if body is not None else {}))
+        try:
+            self.local.connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = self.local.connection.getresponse()
+            response.read()
+        except Exception:
+            del self.local.connection
+            raise
+        if response.status >= 400:
+            raise RuntimeError("%s %s: %d" % (method, path, response.status))
+
+
+class AppTarget(object):
+    """ the Flask app in this process """
+
+    def __init__(self, headers):
+        os.environ.setdefault("SCHEMA_CHECK", "off")
+        from cmdb_view import cmdb_api
+        self.app = cmdb_api()
+        self.headers = headers
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.test_client()
+        response = self.local.client.open(path, method=method, json=body, headers=self.headers)
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s: %d" % (method, path, response.status_code))
+
+
+def snapshot(graph):
+    """ the graph as a cmdb_snapshot.Snapshot, node ids are positions in graph.nodes() """
+    import cmdb_snapshot
+    from cmdb_graph import id_field, models
+
+    id_fields = {label: id_field(model) for label, model in models().items()}
+    result = cmdb_snapshot.Snapshot()
+    for node, (label, props) in enumerate(graph.nodes()):
+        result.add_node(node, [label], props, id_fields)
+    for source, source_id, rel_type, target, target_id, props in graph.edges():
+        result.add_edge(result.keys[(source, source_id)], rel_type, result.keys[(target, target_id)], props)
+    result.loaded_at = time.time()
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except Exception:
+        return None
+
+
+def run(target, graph, names, requests, concurrency, seed=0):
+    results = OrderedDict()
+    for name in names:
+        rng = random.Random("%s:%s" % (seed, name))
+        calls = [SCENARIOS[name](graph, rng) for _ in range(requests)]
+        target.request(*calls[0])  # warm up
+        results[name] = measure(lambda i: target.request(*calls[i]), requests, concurrency)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["http", "inprocess", "snapshot"], default="http")
+    parser.add_argument("--url", default="http://localhost:5000", help="API of the http backend")
+    parser.add_argument("--size", default="10k", help="%s, as loaded with benchmark.generator" % ", ".join(SIZES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=1000, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--cache", action="store_true", help="let the GET cache answer (off by default)")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(unknown))
+
+    graph = Graph(args.size if args.size.lower() in SIZES else int(args.size), args.seed)
+    headers = {} if args.cache else {"Cache-Control": "no-cache"}
+    skipped = {}
+    if args.backend == "http":
+        target = HttpTarget(args.url, headers)
+    else:
+        if args.backend == "snapshot":
+            import cmdb_snapshot
+            cmdb_snapshot.install(snapshot(graph))
+            skipped = {name: {"skipped": "needs neo4j"} for name in names if name not in SNAPSHOT_SCENARIOS}
+            names = [name for name in names if name in SNAPSHOT_SCENARIOS]
+        target = AppTarget(headers)
+
+    report = OrderedDict([
+        ("backend", args.backend), ("size", args.size), ("nodes", len(graph)), ("seed", args.seed),
+        ("requests", args.requests), ("concurrency", args.concurrency), ("cache", args.cache),
+        ("commit", _commit()), ("python", platform.python_version()),
+        ("started_at", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+    ])
+    scenarios = run(target, graph, names, args.requests, args.concurrency, args.seed)
+    scenarios.update(skipped)
+    report["scenarios"] = scenarios
+    dump(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#coding=utf-8
+"""
+asyncio variant of the read API (Quart, served by an ASGI server):
+    hypercorn cmdb_async:app
+
+    GET /v1/<resource>/<id>
+    GET /v1/<resource>/<id>/<secondary>[/<secondary_id>]
+    GET /v1/<resource>/<id>/summary    the node and all its secondary relations
+
+the relations of a summary are independent reads, they are run concurrently
+(one session each) instead of one blocking neomodel call after the other, and
+a worker keeps serving other requests while a slow graph query is pending.
+writes stay on the Flask API (cmdb_view).
+
+the grest.auth hooks of the Flask API run before every request: set them on
+this app too (cmdb_async.app.authentication_function / authorization_function),
+they are called with the view of the resource in a flask request context
+copied from the quart request, so they read flask.request as in cmdb_view.
+without hooks every read is anonymous and `python cmdb_async.py` only listens
+on localhost.
+
+with neo4j >= 5 the async driver is used; with the 4.x driver neomodel
+depends on, queries run on the shared sync driver in a thread pool.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from flask import Flask
+from grest.exceptions import HTTPException
+from quart import Quart, jsonify, request
+
+import cmdb_config
+import cmdb_driver
+import cmdb_projection
+from cmdb_view import RESOURCES
+
+try:
+    from neo4j import AsyncGraphDatabase
+except ImportError:  # neo4j < 5
+    AsyncGraphDatabase = None
+
+
+class Database(object):
+    """ runs cypher queries without blocking the event loop """
+
+    def __init__(self):
+        self.driver = None
+        self.executor = None
+
+    def open(self):
+        if AsyncGraphDatabase is not None:
+            url = urlparse(cmdb_config.DB_URL)
+            credentials, hostname = url.netloc.rsplit("@", 1)
+            username, password = credentials.split(":", 1)
+            self.driver = AsyncGraphDatabase.driver(
+                "%s://%s" % (url.scheme, hostname), auth=(username, password),
+                max_connection_pool_size=cmdb_config.BOLT_MAX_CONNECTION_POOL_SIZE,
+                max_connection_lifetime=cmdb_config.BOLT_MAX_CONNECTION_LIFETIME,
+                connection_acquisition_timeout=cmdb_config.BOLT_CONNECTION_ACQUISITION_TIMEOUT,
+                fetch_size=cmdb_config.BOLT_FETCH_SIZE)
+        else:
+            self.driver = cmdb_driver.shared_driver()
+            self.executor = ThreadPoolExecutor(cmdb_config.BOLT_MAX_CONNECTION_POOL_SIZE)
+
+    async def close(self):
+        if AsyncGraphDatabase is not None:
+            await self.driver.close()
+        else:
+            self.executor.shutdown(wait=False)
+            cmdb_driver.close()
+
+    def _query(self, cypher, params):
+        with self.driver.session() as session:
+            return session.run(cypher, params).data()
+
+    async def query(self, cypher, params=None):
+        """ rows of a query as dicts keyed on the RETURN columns """
+        if AsyncGraphDatabase is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self._query, cypher, params or {})
+
+        async with self.driver.session() as session:
+            result = await session.run(cypher, params or {})
+            return await result.data()
+
+
+database = Database()
+app = Quart(__name__)
+hooks = Flask(__name__)  # request context of the grest.auth hooks
+
+AUTH_HOOKS = ("authentication_function", "authorization_function")
+
+
+@app.before_serving
+async def startup():
+    database.open()
+
+
+@app.after_serving
+async def shutdown():
+    await database.close()
+
+
+def _view(resource):
+    return RESOURCES.get(resource)
+
+
+@app.before_request
+async def check_auth():
+    """ runs the grest.auth hooks with the view of the resource, the error response when they raise """
+    view = _view((request.view_args or {}).get("resource"))
+    functions = [getattr(app, name) for name in AUTH_HOOKS if hasattr(app, name)]
+    if view is None or not functions:
+        return None
+
+    error = None
+    with hooks.test_request_context(request.path, method=request.method, query_string=request.query_string.decode("latin-1"),
+                                    headers=list(request.headers.items())):
+        try:
+            for function in functions:
+                function(view())
+        except HTTPException as e:
+            error = ([e.message], e.status_code)
+        except:
+            logging.exception("authentication of %s failed", request.path)
+            error = (["An error occurred while processing your request."], 500)
+    if error is not None:
+        return jsonify(errors=error[0]), error[1]
+    return None
+
+
+async def node(view, primary_id):
+    rows = await database.query(*cmdb_projection.node_query(view, primary_id))
+    return cmdb_projection.node_document(view, rows)
+
+
+async def related(view, primary_id, name, secondary_id=None):
+    rows = await database.query(*cmdb_projection.related_query(view, primary_id, name, secondary_id=secondary_id))
+    return cmdb_projection.related_document(view, name, rows, secondary_id)
+
+
+@app.route("/v1/<resource>/<primary_id>")
+async def get(resource, primary_id):
+    view = _view(resource)
+    if view is None:
+        return jsonify(errors=["Selected resource does not exists!"]), 404
+
+    document = await node(view, primary_id)
+    if document is None:
+        return jsonify(errors=["Selected %s does not exists!" % view.__model__["primary"].__name__]), 404
+    return jsonify(document), 200
+
+
+@app.route("/v1/<resource>/<primary_id>/<secondary_model_name>")
+@app.route("/v1/<resource>/<primary_id>/<secondary_model_name>/<secondary_id>")
+async def get_related(resource, primary_id, secondary_model_name, secondary_id=None):
+    view = _view(resource)
+    if view is None or secondary_model_name not in view.__model__.get("secondary", {}):
+        return jsonify(errors=["Relation does not exist!"]), 404
+
+    document = await related(view, primary_id, secondary_model_name, secondary_id)
+    if document is None:
+        return jsonify(errors=["Selected %s does not exists!" % view.__model__["primary"].__name__]), 404
+    return jsonify(document), 200
+
+
+@app.route("/v1/<resource>/<primary_id>/summary")
+async def summary(resource, primary_id):
+    view = _view(resource)
+    if view is None:
+        return jsonify(errors=["Selected resource does not exists!"]), 404
+
+    names = list(view.__model__.get("secondary", {}))
+    documents = await asyncio.gather(node(view, primary_id),
+                                     *[related(view, primary_id, name) for name in names])
+    if documents[0] is None:
+        return jsonify(errors=["Selected %s does not exists!" % view.__model__["primary"].__name__]), 404
+    return jsonify(cmdb_projection.summary_document(documents[0], documents[1:])), 200
+
+
+if __name__ == '__main__':
+    # 未设置认证钩子时只监听本机
+    app.run(host='0.0.0.0' if any(hasattr(app, name) for name in AUTH_HOOKS) else '127.0.0.1', port=5001)
@@ -0,0 +1,380 @@
+#coding=utf-8
+"""
+bulk import of nodes (and their secondary relationships)
+
+items are written in fixed-size batches, each batch is one transaction made of
+one UNWIND ... MERGE statement for the nodes and one per relationship name,
+instead of one request (and several transactions) per node.
+
+an item is a node document plus optional relationship keys taken from the
+view's __model__["secondary"], e.g. for HostView:
+    {"host_name": "web01", "private_ip": "10.0.0.1",
+     "environment": "<environment_id>",
+     "app": [{"app_id": "<app_id>", "adopted_since": 2019}]}
+
+relationships between existing nodes are linked the same way (import_links),
+an item names the relationship by its secondary name on the source view:
+    {"op": "connect", "source": "App", "source_id": "<app_id>",
+     "relation": "host", "target_id": "<host_id>", "properties": {"adopted_since": 2019}}
+op is connect (the default), disconnect or replace (connect, and drop the
+other relationships of that name of the source).
+"""
+
+import json
+import logging
+from itertools import islice
+from uuid import uuid4
+
+from neomodel import db
+
+import cmdb_cache
+import cmdb_changes
+from cmdb_graph import id_field, pattern, properties, query, secondary_relations
+
+BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+
+LINK_OPS = ("connect", "disconnect", "replace")
+
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonlines", "application/x-jsonlines")
+
+# transient property set on the nodes created by a MERGE, removed in the same statement
+CREATED_MARKER = "_cmdb_created"
+
+
+def read_items(request):
+    """ items of a request body, either a JSON array or a NDJSON stream (read lazily) """
+    if request.mimetype in NDJSON_MIMETYPES:
+        return _ndjson(request.stream)
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise ValueError("Expecting a JSON array or a NDJSON body")
+    return items
+
+
+def _ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line
+
+
+def _batches(items, size):
+    items = iter(items)
+    offset = 0
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield offset, batch
+        offset += len(batch)
+
+
+def _deflate(fields, key, value):
+    if value is None:
+        return None
+    return fields[key].deflate(value)
+
+
+def _prepare(model, relations, item):
+    """ split an item into the node row and its links, validating every value """
+    if not isinstance(item, dict):
+        raise ValueError("Item is not a JSON object")
+
+    fields = properties(model)
+    node, links = {}, []
+    for key, value in item.items():
+        if key in relations:
+            rel = relations[key]
+            target_field = id_field(rel.model)
+            for target in (value if isinstance(value, list) else [value]):
+                if isinstance(target, dict):
+                    target = dict(target)
+                    target_id = target.pop(target_field, None)
+                    unknown = set(target) - set(rel.properties)
+                    if unknown:
+                        raise ValueError("Unknown relationship properties: %s" % ", ".join(sorted(unknown)))
+                    link_props = {k: _deflate(rel.properties, k, v) for k, v in target.items()}
+                else:
+                    target_id, link_props = target, {}
+                if not isinstance(target_id, str) or not target_id:
+                    raise ValueError("Missing %s for %s" % (target_field, key))
+                links.append((key, target_id, link_props))
+        elif key in fields:
+            node[key] = _deflate(fields, key, value)
+        else:
+            raise ValueError("Unknown property: %s" % key)
+
+    node_id = node.pop(id_field(model), None) or uuid4().hex
+    return node_id, node, links
+
+
+def _missing(relations, links):
+    """ the (index, name, target id) links of a batch whose target does not exist """
+    missing = set()
+    for name, name_links in links.items():
+        if not name_links:
+            continue
+        rel = relations[name]
+        field = id_field(rel.model)
+        found = query("UNWIND $targets AS target "
+                      "MATCH (m:%s {%s: target}) "
+                      "RETURN DISTINCT m.%s AS target" % (rel.model.__label__, field, field),
+                      {"targets": list({link["target"] for link in name_links})})
+        found = {row["target"] for row in found}
+        missing.update((link["index"], name, link["target"]) for link in name_links if link["target"] not in found)
+    return missing
+
+
+def _write(model, relations, rows, links):
+    """
+    write one batch, the targets of its links exist (checked with _missing in
+    the same transaction), returns the ids of the nodes created
+    """
+    label, field = model.__label__, id_field(model)
+
+    # ON CREATE 标记新建的节点, 读出后立即删除
+    created = query("UNWIND $rows AS row "
+                    "MERGE (n:%s {%s: row.id}) "
+                    "ON CREATE SET n.%s = true "
+                    "WITH row, n, n.%s IS NOT NULL AS created "
+                    "REMOVE n.%s "
+                    "SET n += row.properties "
+                    "RETURN DISTINCT row.id AS id, created"
+                    % (label, field, CREATED_MARKER, CREATED_MARKER, CREATED_MARKER),
+                    {"rows": rows})
+    created = {row["id"] for row in created if row["created"]}
+
+    for name, name_links in links.items():
+        if not name_links:
+            continue
+        rel = relations[name]
+        found = query("UNWIND $links AS link "
+                      "MATCH (n:%s {%s: link.source}) "
+                      "MATCH (m:%s {%s: link.target}) "
+                      "MERGE %s "
+                      "SET r += link.properties "
+                      "RETURN count(*) AS count"
+                      % (label, field, rel.model.__label__, id_field(rel.model),
+                         pattern(rel, label=False)),
+                      {"links": name_links})
+        if found[0]["count"] != len(name_links):
+            # 目标在检查之后被删除, 整批回滚
+            raise RuntimeError("%s targets were deleted meanwhile" % name)
+    return created
+
+
+def _node_changes(view, rows, links, created):
+    """ change log entries of a written batch, nodes are merged: created (ids in created) or updated """
+    resource = cmdb_changes.resource(view.__model__["primary"])
+    changes = []
+    for row in rows:
+        # 同一批内重复的 id 只有第一次是 create
+        op = "create" if row["id"] in created else "update"
+        created.discard(row["id"])
+        changes.append(cmdb_changes.change(op, resource, row["id"], data=row["properties"]))
+    for name, name_links in links.items():
+        changes.extend(cmdb_changes.change("connect", resource, link["source"], name, link["target"],
+                                           link["properties"])
+                       for link in name_links)
+    return changes
+
+
+def import_nodes(view, items, batch_size=BATCH_SIZE):
+    """
+    create or update the primary nodes of view (merged on their *_id)
+    and connect them to the secondary nodes they reference, an item
+    referencing a node that does not exist is not written
+
+    returns one result per item, in input order
+    """
+    model = view.__model__["primary"]
+    relations = secondary_relations(view)
+    field = id_field(model)
+
+    results = []
+    for offset, batch in _batches(items, batch_size):
+        rows, links, written = [], {}, {}
+        for index, item in enumerate(batch, offset):
+            try:
+                node_id, node, item_links = _prepare(model, relations, item)
+            except ValueError as e:
+                results.append({"index": index, "errors": [str(e)]})
+                continue
+
+            rows.append({"index": index, "id": node_id, "properties": node})
+            for name, target_id, link_props in item_links:
+                links.setdefault(name, []).append({"index": index, "source": node_id,
+                                                   "target": target_id, "properties": link_props})
+            written[index] = {"index": index, field: node_id, "result": "OK"}
+            results.append(written[index])
+
+        if not rows:
+            continue
+
+        try:
+            with db.transaction:
+                missing = _missing(relations, links)
+                skipped = {index for index, _, _ in missing}
+                rows = [row for row in rows if row["index"] not in skipped]
+                links = {name: [link for link in name_links if link["index"] not in skipped]
+                         for name, name_links in links.items()}
+                created = _write(model, relations, rows, links)
+                cmdb_changes.append(_node_changes(view, rows, links, created))
+        except Exception as e:
+            logging.exception(e)
+            for result in written.values():
+                del result["result"]
+                result["errors"] = ["Batch could not be written: %s" % e]
+            continue
+
+        cmdb_changes.notify()
+        touched = {row["id"] for row in rows}
+        touched.update(link["target"] for name_links in links.values() for link in name_links)
+        touched.add(cmdb_cache.label_tag(model))
+        cmdb_cache.invalidate(touched)
+
+        for index, name, target_id in sorted(missing):
+            result = written[index]
+            result.pop("result", None)
+            result.setdefault("errors", []).append("%s %s does not exist" % (name, target_id))
+
+    return results
+
+
+def _prepare_link(views, item):
+    """ (op, view, relation, source id, target id, properties) of a link item, validating every value """
+    if not isinstance(item, dict):
+        raise ValueError("Item is not a JSON object")
+
+    op = item.get("op", "connect")
+    if op not in LINK_OPS:
+        raise ValueError("Unknown op: %s" % op)
+    source, relation = item.get("source"), item.get("relation")
+    if not isinstance(source, str) or not isinstance(relation, str):
+        raise ValueError("source and relation expect a name")
+    view = views.get(source.lower())
+    if view is None:
+        raise ValueError("Unknown source: %s" % source)
+    relations = secondary_relations(view)
+    rel = relations.get(relation)
+    if rel is None:
+        raise ValueError("Unknown relation: %s" % item.get("relation"))
+
+    source_id, target_id = item.get("source_id"), item.get("target_id")
+    if not isinstance(source_id, str) or not source_id or not isinstance(target_id, str) or not target_id:
+        raise ValueError("Missing source_id or target_id")
+
+    link_props = item.get("properties") or {}
+    if not isinstance(link_props, dict):
+        raise ValueError("properties is not a JSON object")
+    unknown = set(link_props) - set(rel.properties)
+    if unknown:
+        raise ValueError("Unknown relationship properties: %s" % ", ".join(sorted(unknown)))
+    link_props = {k: _deflate(rel.properties, k, v) for k, v in link_props.items()}
+    return op, view, rel, source_id, target_id, link_props
+
+
+def _link(model, rel, op, links):
+    """ apply links of one op on one relation, returns the indexes whose source and target exist """
+    label, field = model.__label__, id_field(model)
+    match = ("UNWIND $links AS link "
+             "MATCH (n:%s {%s: link.source}) "
+             "MATCH (m:%s {%s: link.target}) "
+             % (label, field, rel.model.__label__, id_field(rel.model)))
+
+    if op == "disconnect":
+        found = query(match +
+                      "OPTIONAL MATCH %s "
+                      "DELETE r "
+                      "RETURN DISTINCT link.index AS index" % pattern(rel, label=False),
+                      {"links": links})
+    else:
+        found = query(match +
+                      "MERGE %s "
+                      "SET r += link.properties "
+                      "RETURN link.index AS index" % pattern(rel, label=False),
+                      {"links": links})
+    return {row["index"] for row in found}
+
+
+def _unlink_others(model, rel, links):
+    """ drop the relationships of the replaced sources to targets they are not linked to in links """
+    if not links:
+        return
+    targets = {}
+    for link in links:
+        targets.setdefault(link["source"], []).append(link["target"])
+    query("UNWIND $groups AS group "
+          "MATCH (n:%s {%s: group.source}) "
+          "MATCH %s WHERE NOT m.%s IN group.targets "
+          "DELETE r"
+          % (model.__label__, id_field(model), pattern(rel), id_field(rel.model)),
+          {"groups": [{"source": source, "targets": group} for source, group in targets.items()]})
+
+
+def import_links(views, items, batch_size=BATCH_SIZE):
+    """
+    connect / disconnect / replace relationships between existing nodes, views is
+    route base -> view. in a batch the replaces are applied first, then the
+    connects are merged and the disconnects deleted
+
+    returns one result per item, in input order
+    """
+    results = []
+    for offset, batch in _batches(items, batch_size):
+        groups, written = {}, {}
+        for index, item in enumerate(batch, offset):
+            try:
+                op, view, rel, source_id, target_id, link_props = _prepare_link(views, item)
+            except ValueError as e:
+                results.append({"index": index, "errors": [str(e)]})
+                continue
+
+            group = groups.setdefault((view, rel.name, op), (view.__model__["primary"], rel, op, []))
+            group[3].append({"index": index, "source": source_id, "target": target_id, "properties": link_props})
+            written[index] = {"index": index, "result": "OK"}
+            results.append(written[index])
+
+        if not groups:
+            continue
+
+        order = {"replace": 0, "connect": 1, "disconnect": 2}
+        try:
+            found = set()
+            with db.transaction:
+                for model, rel, op, links in sorted(groups.values(), key=lambda group: order[group[2]]):
+                    linked = _link(model, rel, op, links)
+                    if op == "replace":
+                        # only once the new target is known to exist
+                        _unlink_others(model, rel, [link for link in links if link["index"] in linked])
+                    found.update(linked)
+                    cmdb_changes.append([cmdb_changes.change(op, cmdb_changes.resource(model), link["source"],
+                                                             rel.name, link["target"], link["properties"])
+                                         for link in links if link["index"] in linked])
+        except Exception as e:
+            logging.exception(e)
+            for result in written.values():
+                del result["result"]
+                result["errors"] = ["Batch could not be written: %s" % e]
+            continue
+
+        cmdb_changes.notify()
+        touched = set()
+        for model, rel, op, links in groups.values():
+            touched.update(link["source"] for link in links)
+            touched.update(link["target"] for link in links)
+            touched.add(cmdb_cache.label_tag(model))
+            touched.add(cmdb_cache.label_tag(rel.model))
+        cmdb_cache.invalidate(touched)
+
+        for index, result in written.items():
+            if index not in found:
+                del result["result"]
+                result["errors"] = ["Source or target does not exist"]
+
+    return results
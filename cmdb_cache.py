@@ -0,0 +1,270 @@
+#coding=utf-8
+"""
+read-through cache of the GET responses of the CMDB views
+
+every cached response is tagged with the ids it shows (the ids in the url and
+every *_id found in the body) and, for list responses, with the label listed.
+a POST/PUT/PATCH/DELETE invalidates the tags of the nodes it touches (primary
+and secondary ids of the url) and of the primary label, so a write on an App
+also drops /environment/<id>/app, /host/<id>/impact, ... that contain it.
+
+responses are keyed on the credentials of the caller (Authorization, Cookie)
+as well, and a cached response is only served after the grest.auth hooks
+allowed the request (see CMDBView.before_request).
+
+the default backend is an in-process LRU with a TTL; the TTL also bounds how
+stale other worker processes can be, use a shared backend (see RedisCache)
+when that is not acceptable.
+"""
+
+import hashlib
+import json
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response
+
+MAX_ENTRIES = 10000
+TTL = 30
+
+CACHEABLE_MIMETYPES = ("application/json",)
+SKIPPED_HEADERS = ("Content-Length", "Set-Cookie")
+CREDENTIAL_HEADERS = ("Authorization", "Cookie")
+
+
+class Stats(object):
+    """ counters of a cache backend, exposed on /v1/cache """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class MemoryCache(object):
+    """ in-process LRU + TTL cache with tag invalidation """
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = Stats()
+        self._entries = OrderedDict()  # key -> (expires, tags, value)
+        self._tags = {}  # tag -> keys
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        _, tags, _ = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            if entry[0] < time.time():
+                self._drop(key)
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[2]
+
+    def set(self, key, value, tags):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.time() + self.ttl, frozenset(tags), value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def invalidate(self, tags):
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                if key in self._entries:
+                    self._drop(key)
+            self.stats.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+
+class RedisCache(object):
+    """
+    shared cache backend on top of a redis client (redis.Redis(...)),
+    tags are redis sets of cache keys. evictions are left to redis.
+    """
+
+    def __init__(self, client, ttl=TTL, prefix="cmdb:cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats = Stats()
+
+    def __len__(self):
+        return 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value, tags):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+        for tag in tags:
+            pipe.sadd(self.prefix + "tag:" + tag, key)
+            pipe.expire(self.prefix + "tag:" + tag, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, tags):
+        keys = set()
+        for tag in tags:
+            keys.update(key.decode("utf-8") if isinstance(key, bytes) else key
+                        for key in self.client.smembers(self.prefix + "tag:" + tag))
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+        if tags:
+            self.client.delete(*[self.prefix + "tag:" + tag for tag in tags])
+        self.stats.invalidations += len(keys)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+backend = MemoryCache()
+
+
+def configure(new_backend):
+    """ replace the cache backend (e.g. with a RedisCache shared by all workers) """
+    global backend
+    backend = new_backend
+
+
+def label_tag(model):
+    return "label:" + model.__label__
+
+
+def _ids(document, ids):
+    """ every id shown in a JSON document (values of the *_id and id keys) """
+    if isinstance(document, dict):
+        for key, value in document.items():
+            if isinstance(value, str) and (key == "id" or key.endswith("_id")):
+                ids.add(value)
+            else:
+                _ids(value, ids)
+    elif isinstance(document, list):
+        for value in document:
+            _ids(value, ids)
+    return ids
+
+
+def _url_ids(request):
+    return {value for key, value in (request.view_args or {}).items() if key.endswith("_id") and value}
+
+
+def _credentials(request):
+    """ digest of what identifies the caller, a response is only replayed to the same credentials """
+    digest = hashlib.sha1()
+    for header in CREDENTIAL_HEADERS:
+        digest.update(request.headers.get(header, "").encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+def _key(request):
+    return "%s %s|%s|%s" % (request.method, request.full_path, request.headers.get("Accept", ""),
+                            _credentials(request))
+
+
+def lookup(request):
+    """ the cached response of a GET request, or None """
+    if any([request.method != "GET",
+            "no-cache" in request.headers.get("Cache-Control", ""),
+            "_profile" in request.args]):
+        return None
+    entry = backend.get(_key(request))
+    if entry is None:
+        return None
+    body, status, headers = entry
+    response = Response(body, status=status, headers=headers)
+    response.headers["X-Cache"] = "HIT"
+    return response
+
+
+def store(view, request, response, tags=()):
+    """
+    cache a successful JSON GET response of view, tagged with the ids it shows
+    and with tags (e.g. the label tags of aggregated labels)
+    """
+    if any([request.method != "GET",
+            "_profile" in request.args,
+            response.status_code != 200,
+            response.is_streamed,
+            response.mimetype not in CACHEABLE_MIMETYPES]):
+        return response
+
+    body = response.get_data()
+    try:
+        tags = _ids(json.loads(body.decode("utf-8")), set(tags))
+    except ValueError:
+        return response
+    tags.update(_url_ids(request))
+    if not request.view_args:
+        tags.add(label_tag(view.__model__["primary"]))
+
+    for header in CREDENTIAL_HEADERS:
+        response.vary.add(header)
+    headers = [(k, v) for k, v in response.headers.items() if k not in SKIPPED_HEADERS]
+    try:
+        backend.set(_key(request), (body, response.status_code, headers), tags)
+    except Exception:
+        logging.exception("could not cache %s", request.full_path)
+    response.headers["X-Cache"] = "MISS"
+    return response
+
+
+def invalidate(tags):
+    try:
+        backend.invalidate(set(tags))
+    except Exception:
+        logging.exception("could not invalidate %s", tags)
+
+
+def invalidate_write(view, request):
+    """ drop the cached responses showing the nodes touched by a write on view """
+    tags = _url_ids(request)
+    tags.add(label_tag(view.__model__["primary"]))
+    invalidate(tags)
+
+
+def stats():
+    return dict(backend.stats.to_dict(), entries=len(backend), backend=type(backend).__name__)
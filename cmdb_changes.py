@@ -0,0 +1,325 @@
+#coding=utf-8
+"""
+change feed of the CMDB: an ordered, durable log of the writes
+
+every create, update, delete and connect / disconnect / replace of a
+relationship made through the API (GRest views, /bulk, /relationships/batch)
+appends a change to the log, stored in neo4j next to the graph:
+    (:Change {seq, time, op, resource, id, relation, target_id, data, request_id})
+seq is taken from a (:ChangeSequence) counter node, whose lock is held until
+the writing transaction commits, so the seqs are gap free and committed in
+order: a reader that saw seq N has seen every change up to N.
+every write appends its changes in its own transaction: the bulk writes in
+theirs, the GRest writes in the one CMDBView opens around the GRest verb
+(see transaction), so a change is in the log if and only if its write
+committed.
+
+consumers resume from the last seq they processed:
+    GET /v1/changes?since=<seq>[&limit=][&resource=host,app][&wait=30]
+        {"changes": [...], "next_since": <seq>}, wait long-polls until a change comes
+    GET /v1/changes?since=<seq> with Accept: text/event-stream
+        server-sent events (id: <seq>), resumed with Last-Event-ID
+a stream or a long-poll holds a worker thread, at most CHANGES_MAX_STREAMS of
+them wait at once per process (more streams answer 503, more long-polls
+answer at once); they share one read of the head of the log per POLL_INTERVAL.
+a since older than the pruned part of the log answers 410, resync then.
+
+webhooks (WEBHOOK_URLS) are fed in batches by one process, outside the API:
+    python cmdb_changes.py deliver    POST {"changes": [...]} to every url, at least once,
+                                      the cursor of each url is kept in neo4j
+    python cmdb_changes.py prune      drop the changes older than CHANGES_RETENTION_DAYS
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.request import Request, urlopen
+
+from flask import g, has_request_context
+from neomodel import db
+
+import cmdb_config
+from cmdb_graph import query
+
+OPS = ("create", "update", "delete", "connect", "disconnect", "replace")
+
+SEQUENCE = "changes"
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_WAIT = 60  # seconds, long-poll
+POLL_INTERVAL = 1.0  # seconds between two reads of the log while waiting
+HEARTBEAT = 15  # seconds, server-sent events
+STREAM_SECONDS = 300  # an event stream is closed after that, the client reconnects
+
+# (label, property, unique) indexes of the log, created by cmdb_schema
+INDEXES = (("Change", "seq", True), ("ChangeSequence", "name", True))
+
+
+class Pruned(Exception):
+    """ the changes after since are not all in the log any more """
+
+
+# observer(changes) called in the transaction that appends them (see cmdb_history)
+OBSERVERS = []
+
+# 本进程内有新变更时唤醒等待的长轮询, 其他进程的变更靠 POLL_INTERVAL 轮询
+_appended = threading.Condition()
+
+# 等待中的请求共用一次 head 查询, 而不是每个连接每秒查一次
+_head, _head_at = 0, 0
+_head_lock = threading.Lock()
+
+# 流和长轮询会一直占用一个工作线程, 每个进程最多 CHANGES_MAX_STREAMS 个
+_streams = threading.BoundedSemaphore(cmdb_config.CHANGES_MAX_STREAMS)
+
+
+@contextmanager
+def transaction():
+    """
+    a transaction joined by the `with db.transaction` blocks run inside it
+    (the GRest verbs), committed at the end unless one of them rolled back
+    """
+    # GRest 的写操作自己开事务 (with db.transaction), neomodel 不能嵌套事务;
+    # db 是线程局部的, 只在本线程、本 with 块内把 begin / commit / rollback
+    # 换成空操作, 由这里统一提交或回滚, 其他调用方不受影响
+    db.begin()
+    joined = {"rollback": False}
+
+    def rollback(*args, **kwargs):
+        joined["rollback"] = True
+
+    db.begin = db.commit = lambda *args, **kwargs: None
+    db.rollback = rollback
+    try:
+        yield
+    except BaseException:
+        joined["rollback"] = True
+        raise
+    finally:
+        del db.begin, db.commit, db.rollback
+        if joined["rollback"]:
+            db.rollback()
+        else:
+            db.commit()
+
+
+def resource(model):
+    """ resource name of a node model, the route base of its view (/v1/<resource>) """
+    return model.__name__.lower()
+
+
+def change(op, resource, node_id, relation=None, target_id=None, data=None):
+    """ a change to append, data is the written document (properties) """
+    return {"op": op, "resource": resource, "id": node_id, "relation": relation, "target_id": target_id,
+            "data": json.dumps(data, default=str) if data else None,
+            "request_id": g.get("request_id") if has_request_context() else None}
+
+
+def append(changes):
+    """ append changes to the log and pass them to the OBSERVERS, in the current transaction, returns their seqs """
+    if not changes:
+        return []
+    for observer in OBSERVERS:
+        observer(changes)
+    if not cmdb_config.CHANGES:
+        return []
+    rows = query("MERGE (s:ChangeSequence {name: $name}) "
+                 "SET s.seq = coalesce(s.seq, 0) + size($changes) "
+                 "WITH s.seq - size($changes) AS first "
+                 "UNWIND range(0, size($changes) - 1) AS i "
+                 "CREATE (c:Change) "
+                 "SET c = $changes[i], c.seq = first + i + 1, c.time = timestamp() "
+                 "RETURN c.seq AS seq",
+                 {"name": SEQUENCE, "changes": changes})
+    return [row["seq"] for row in rows]
+
+
+def notify():
+    """ wake up the long-polls of this process, once the appended changes are committed """
+    global _head_at
+    with _head_lock:
+        _head_at = 0
+    with _appended:
+        _appended.notify_all()
+
+
+def _document(properties):
+    document = dict(properties)
+    if document.get("data") is not None:
+        document["data"] = json.loads(document["data"])
+    return document
+
+
+def head():
+    """ (last seq, last pruned seq) of the log """
+    rows = query("MATCH (s:ChangeSequence {name: $name}) RETURN s.seq AS seq, s.pruned AS pruned",
+                 {"name": SEQUENCE})
+    if not rows:
+        return 0, 0
+    return rows[0]["seq"] or 0, rows[0]["pruned"] or 0
+
+
+def read(since, limit=DEFAULT_LIMIT, resources=None):
+    """
+    {"changes": changes after since (of resources), "next_since": seq to resume from}
+    raises Pruned when since is older than the log
+    """
+    last, pruned = head()
+    if since < pruned:
+        raise Pruned(since)
+    if last <= since:
+        return {"changes": [], "next_since": since}
+
+    where = " AND c.resource IN $resources" if resources else ""
+    rows = query("MATCH (c:Change) WHERE c.seq > $since AND c.seq <= $last%s "
+                 "RETURN properties(c) AS change ORDER BY c.seq LIMIT $limit" % where,
+                 {"since": since, "last": last, "limit": limit, "resources": resources})
+    changes = [_document(row["change"]) for row in rows]
+    # a short page holds every change up to last, filtered ones included
+    next_since = changes[-1]["seq"] if len(changes) == limit else last
+    return {"changes": changes, "next_since": next_since}
+
+
+def shared_head():
+    """ last seq of the log, read at most once per POLL_INTERVAL for all the waiting requests of the process """
+    global _head, _head_at
+    with _head_lock:
+        if time.time() - _head_at >= POLL_INTERVAL:
+            _head, _head_at = head()[0], time.time()
+        return _head
+
+
+def wait(since, limit=DEFAULT_LIMIT, resources=None, timeout=0):
+    """ read, waiting up to timeout seconds for a change when there is none yet """
+    deadline = time.time() + timeout
+    result = read(since, limit, resources)
+    while not result["changes"] and time.time() < deadline:
+        since = result["next_since"]
+        with _appended:
+            _appended.wait(min(POLL_INTERVAL, max(0, deadline - time.time())))
+        if shared_head() > since:
+            result = read(since, limit, resources)
+    return result
+
+
+def acquire_stream():
+    """ a slot for a stream or a long-poll, False when CHANGES_MAX_STREAMS requests of the process already wait """
+    return _streams.acquire(blocking=False)
+
+
+def release_stream():
+    _streams.release()
+
+
+def events(since, resources=None, duration=STREAM_SECONDS):
+    """ server-sent events of the changes after since, for duration seconds """
+    yield "retry: 3000\n\n"
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        result = wait(since, MAX_LIMIT, resources, min(HEARTBEAT, max(0, deadline - time.time())))
+        for item in result["changes"]:
+            yield "id: %d\nevent: change\ndata: %s\n\n" % (item["seq"], json.dumps(item, default=str))
+        if not result["changes"]:
+            yield ": heartbeat\n\n"
+        since = result["next_since"]
+
+
+def prune(days):
+    """ drop the changes older than days, returns how many """
+    cutoff = int((time.time() - days * 86400) * 1000)
+    total = 0
+    while True:
+        rows = query("MATCH (c:Change) WHERE c.time < $cutoff "
+                     "WITH c LIMIT 10000 "
+                     "WITH collect(c) AS changes, max(c.seq) AS last "
+                     "FOREACH (c IN changes | DELETE c) "
+                     "WITH size(changes) AS deleted, last "
+                     "MATCH (s:ChangeSequence {name: $name}) "
+                     "SET s.pruned = CASE WHEN last > coalesce(s.pruned, 0) THEN last ELSE s.pruned END "
+                     "RETURN deleted",
+                     {"cutoff": cutoff, "name": SEQUENCE})
+        deleted = rows[0]["deleted"] if rows else 0
+        total += deleted
+        if deleted == 0:
+            return total
+
+
+def _cursor(url):
+    rows = query("MERGE (w:ChangeCursor {url: $url}) "
+                 "ON CREATE SET w.seq = coalesce([(s:ChangeSequence {name: $name}) | s.seq][0], 0) "
+                 "RETURN w.seq AS seq",
+                 {"url": url, "name": SEQUENCE})
+    return rows[0]["seq"]
+
+
+def _post(url, changes):
+    body = json.dumps({"changes": changes}, default=str).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if cmdb_config.WEBHOOK_SECRET:
+        digest = hmac.new(cmdb_config.WEBHOOK_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        headers["X-CMDB-Signature"] = "sha256=" + digest
+    with urlopen(Request(url, body, headers), timeout=cmdb_config.WEBHOOK_TIMEOUT) as response:
+        response.read()
+
+
+def deliver(urls, batch_size):
+    """
+    POST the new changes to every url in batches, forever; a url that fails is
+    retried with a growing delay, the others go on
+    """
+    retry_at, delays = {}, {}
+    while True:
+        for url in urls:
+            if retry_at.get(url, 0) > time.time():
+                continue
+            try:
+                since = _cursor(url)
+                changes = read(since, batch_size)["changes"]
+                if changes:
+                    _post(url, changes)
+                    query("MATCH (w:ChangeCursor {url: $url}) SET w.seq = $seq",
+                          {"url": url, "seq": changes[-1]["seq"]})
+                    logging.info("delivered changes %d..%d to %s", changes[0]["seq"], changes[-1]["seq"], url)
+                delays.pop(url, None)
+            except Pruned:
+                logging.error("changes after the cursor of %s were pruned, the webhook has to resync", url)
+                query("MATCH (w:ChangeCursor {url: $url}) DELETE w", {"url": url})
+            except Exception:
+                delays[url] = min(delays.get(url, 1) * 2, 300)
+                retry_at[url] = time.time() + delays[url]
+                logging.exception("could not deliver the changes to %s, retrying in %ds", url, delays[url])
+        time.sleep(POLL_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["deliver", "prune"])
+    parser.add_argument("--days", type=int, default=cmdb_config.CHANGES_RETENTION_DAYS,
+                        help="prune: changes kept")
+    args = parser.parse_args()
+
+    import cmdb_metrics
+    import neomodel
+    cmdb_metrics.configure_logging()
+    neomodel.config.DATABASE_URL = cmdb_config.DB_URL
+
+    if args.command == "prune":
+        print("pruned %d changes" % prune(args.days))
+        return 0
+
+    urls = [url.strip() for url in cmdb_config.WEBHOOK_URLS.split(",") if url.strip()]
+    if not urls:
+        sys.stderr.write("no WEBHOOK_URLS\n")
+        return 1
+    deliver(urls, cmdb_config.WEBHOOK_BATCH_SIZE)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
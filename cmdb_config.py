@@ -0,0 +1,77 @@
+#coding=utf-8
+"""
+settings of the API, on top of global_config
+
+every setting can be overridden in global_config or by an environment
+variable of the same name (the environment wins).
+"""
+
+import multiprocessing
+import os
+
+import global_config
+from global_config import *
+
+
+def setting(name, default, cast=str):
+    return cast(os.getenv(name, getattr(global_config, name, default)))
+
+
+def flag(value):
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+# Bolt driver, one per worker process (see cmdb_driver)
+BOLT_MAX_CONNECTION_POOL_SIZE = setting("BOLT_MAX_CONNECTION_POOL_SIZE", 50, int)
+BOLT_MAX_CONNECTION_LIFETIME = setting("BOLT_MAX_CONNECTION_LIFETIME", 3600, int)  # seconds
+BOLT_CONNECTION_ACQUISITION_TIMEOUT = setting("BOLT_CONNECTION_ACQUISITION_TIMEOUT", 30.0, float)  # seconds
+BOLT_FETCH_SIZE = setting("BOLT_FETCH_SIZE", 1000, int)  # records per pull, bounds streaming memory
+
+# JSON logs (see cmdb_metrics), LOG_FILE="" logs to stderr
+LOG_FILE = setting("LOG_FILE", "logger.log")
+LOG_LEVEL = setting("LOG_LEVEL", "INFO")
+
+# cypher statements slower than this go to the slow-query log, 0 disables it (see cmdb_profile)
+SLOW_QUERY_MS = setting("SLOW_QUERY_MS", 500.0, float)
+# ?_profile=1 returns the statements of a request and their plans, debug only
+PROFILING = setting("PROFILING", False, flag)
+
+# indexes checked when the API starts: warn, strict (refuse to start) or off (see cmdb_schema)
+SCHEMA_CHECK = setting("SCHEMA_CHECK", "warn")
+
+# in-memory graph snapshot per process (see cmdb_snapshot)
+SNAPSHOT = setting("SNAPSHOT", False, flag)
+SNAPSHOT_REFRESH = setting("SNAPSHOT_REFRESH", 10, int)  # seconds between two catch-ups on the change log (CHANGES)
+SNAPSHOT_RELOAD = setting("SNAPSHOT_RELOAD", 3600, int)  # seconds between two full loads
+SNAPSHOT_MAX_STALENESS = setting("SNAPSHOT_MAX_STALENESS", 300, int)  # seconds, older snapshots are not used
+
+# change feed (see cmdb_changes), webhooks are fed by python cmdb_changes.py deliver
+CHANGES = setting("CHANGES", True, flag)
+CHANGES_RETENTION_DAYS = setting("CHANGES_RETENTION_DAYS", 30, int)
+CHANGES_MAX_STREAMS = setting("CHANGES_MAX_STREAMS", 4, int)  # streams / long-polls per worker, keep below THREADS
+WEBHOOK_URLS = setting("WEBHOOK_URLS", "")  # comma separated
+WEBHOOK_SECRET = setting("WEBHOOK_SECRET", "")  # signs the bodies, X-CMDB-Signature: sha256=<hmac>
+WEBHOOK_BATCH_SIZE = setting("WEBHOOK_BATCH_SIZE", 100, int)
+WEBHOOK_TIMEOUT = setting("WEBHOOK_TIMEOUT", 10.0, float)  # seconds
+
+# versions of the nodes and relationships, for ?as_of= and /v1/diff (see cmdb_history)
+HISTORY = setting("HISTORY", True, flag)
+
+# consistency scanner, python cmdb_consistency.py run (see cmdb_consistency)
+CONSISTENCY_BUDGET = setting("CONSISTENCY_BUDGET", 0.05, float)  # share of the time spent in queries
+CONSISTENCY_CHUNK_SIZE = setting("CONSISTENCY_CHUNK_SIZE", 500, int)  # nodes per query
+CONSISTENCY_INTERVAL = setting("CONSISTENCY_INTERVAL", 3600, int)  # seconds between two passes
+
+# GET /v1/topology, compact topology of an environment (see cmdb_topology)
+TOPOLOGY_TTL = setting("TOPOLOGY_TTL", 300, int)  # seconds, also rebuilt after a change to its nodes
+TOPOLOGY_CACHE_SIZE = setting("TOPOLOGY_CACHE_SIZE", 16, int)  # environments kept per process
+
+# POST /v1/query, compiled query shapes kept per process (see cmdb_query)
+QUERY_PLAN_CACHE_SIZE = setting("QUERY_PLAN_CACHE_SIZE", 256, int)
+
+# pre-fork server (gunicorn.conf.py)
+BIND = setting("BIND", "0.0.0.0:5000")
+WORKERS = setting("WORKERS", multiprocessing.cpu_count() * 2 + 1, int)
+THREADS = setting("THREADS", 8, int)
+TIMEOUT = setting("TIMEOUT", 60, int)
+MAX_REQUESTS = setting("MAX_REQUESTS", 10000, int)
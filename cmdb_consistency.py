@@ -0,0 +1,242 @@
+#coding=utf-8
+"""
+consistency scanner of the graph, a background job next to the API
+
+every label of cmdb_model is walked in chunks of CONSISTENCY_CHUNK_SIZE nodes,
+in the order of its unique id (keyset scan on the id index, like cmdb_paging),
+and each node is checked for:
+    missing      fewer relationships of a RULES relation than its minimum
+    too_many     more than its maximum
+    orphan       no relationship at all
+    undeclared   a relationship type / direction / label that cmdb_model does not declare
+the issues of a chunk replace the previous ones of the same id range, so the
+report is refreshed incrementally. the position of the scan is checkpointed in
+neo4j after every chunk and a restarted scanner resumes from there.
+
+the scanner keeps its database time under CONSISTENCY_BUDGET (a fraction of
+wall time): after a chunk taking t seconds of queries it sleeps
+t * (1 / budget - 1), so it slows down with the database instead of competing
+with the API.
+
+    python cmdb_consistency.py run     scan forever, a pass every CONSISTENCY_INTERVAL seconds
+    python cmdb_consistency.py once    finish the current pass
+
+the report is served on GET /v1/health/consistency.
+"""
+
+import argparse
+import sys
+import time
+
+from neomodel import db
+from neomodel.relationship_manager import OUTGOING
+
+import cmdb_config
+from cmdb_graph import id_field, models, pattern, query, relation
+
+# (label, relationship of cmdb_model, min, max), max None is unbounded
+RULES = (
+    ("App", "environment", 1, 1),
+    ("App", "person", 1, None),
+    ("DB", "environment", 1, 1),
+    ("DB", "host", 1, None),
+    ("DatabaseConnect", "db", 1, 1),
+    ("DatabaseConnect", "environment", 1, 1),
+    ("FileServer", "environment", 1, 1),
+    ("Host", "environment", 1, 1),
+    ("K8SNamespace", "environment", 1, 1),
+    ("K8SNamespace", "k8s", 1, 1),
+    ("MD", "environment", 1, 1),
+)
+
+CHECKS = ("orphan", "missing", "too_many", "undeclared")
+
+CHECKPOINT = "consistency"
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# (label, property, unique) indexes of the report, created by cmdb_schema
+INDEXES = (("ConsistencyIssue", "node_id", False), ("ConsistencyCheckpoint", "name", True))
+
+
+def _target(definition):
+    target = definition._raw_class
+    return models().get(target if isinstance(target, str) else target.__name__)
+
+
+def rules():
+    """ {label: [(relation name, Relation, min, max)]} of RULES """
+    by_label = {}
+    for label, name, low, high in RULES:
+        model = models()[label]
+        rel = relation(model, name, _target(model.defined_properties(aliases=False, properties=False)[name]))
+        by_label.setdefault(label, []).append((name, rel, low, high))
+    return by_label
+
+
+def declared():
+    """ every (source label, type, target label) declared on either side in cmdb_model """
+    edges = set()
+    for label, model in models().items():
+        for definition in model.defined_properties(aliases=False, properties=False).values():
+            target = _target(definition)
+            if target is None:
+                continue
+            rel_type = definition.definition["relation_type"]
+            if definition.definition["direction"] == OUTGOING:
+                edges.add((label, rel_type, target.__label__))
+            else:
+                edges.add((target.__label__, rel_type, label))
+    return edges
+
+
+def check_chunk(model, after, size, label_rules, edges):
+    """ (issues, last id) of the size nodes of model after the id after, last id None past the end """
+    label, field = model.__label__, id_field(model)
+    counts = "".join(", size([%s | 1]) AS rule_%d" % (pattern(rel), index)
+                     for index, (_, rel, _, _) in enumerate(label_rules))
+    rows = query("MATCH (n:%s) WHERE n.%s > $after "
+                 "WITH n ORDER BY n.%s LIMIT $size "
+                 "CALL { WITH n MATCH (n)-[r]->(m) RETURN collect(DISTINCT [type(r), head(labels(m))]) AS outgoing } "
+                 "CALL { WITH n MATCH (n)<-[r]-(m) RETURN collect(DISTINCT [type(r), head(labels(m))]) AS incoming } "
+                 "RETURN n.%s AS id, size((n)--()) AS degree, outgoing, incoming%s "
+                 "ORDER BY id"
+                 % (label, field, field, field, counts),
+                 {"after": after, "size": size})
+
+    issues = []
+    for row in rows:
+        def issue(check, relation=None, count=None, expected=None):
+            issues.append({"label": label, "node_id": row["id"], "check": check, "relation": relation,
+                           "count": count, "expected": expected})
+
+        if row["degree"] == 0:
+            issue("orphan")
+        for index, (name, rel, low, high) in enumerate(label_rules):
+            count = row["rule_%d" % index]
+            expected = "%d..%s" % (low, "*" if high is None else high)
+            if count < low:
+                issue("missing", name, count, expected)
+            elif high is not None and count > high:
+                issue("too_many", name, count, expected)
+        undeclared = sorted(["-[%s]->(%s)" % (rel_type, other) for rel_type, other in row["outgoing"]
+                             if (label, rel_type, other) not in edges] +
+                            ["<-[%s]-(%s)" % (rel_type, other) for rel_type, other in row["incoming"]
+                             if (other, rel_type, label) not in edges])
+        for edge in undeclared:
+            issue("undeclared", edge)
+
+    last = rows[-1]["id"] if len(rows) == size else None
+    return issues, last
+
+
+def _save(label, after, last, issues, checkpoint):
+    """ replace the issues of the scanned range and move the checkpoint, in one transaction """
+    upper = " AND i.node_id <= $last" if last is not None else ""
+    with db.transaction:
+        query("MATCH (i:ConsistencyIssue) WHERE i.node_id > $after%s AND i.label = $label DELETE i" % upper,
+              {"label": label, "after": after, "last": last})
+        if issues:
+            query("UNWIND $issues AS issue CREATE (i:ConsistencyIssue) SET i = issue, i.found_at = timestamp()",
+                  {"issues": issues})
+        query("MERGE (c:ConsistencyCheckpoint {name: $name}) SET c += $checkpoint",
+              {"name": CHECKPOINT, "checkpoint": checkpoint})
+
+
+def checkpoint():
+    rows = query("MATCH (c:ConsistencyCheckpoint {name: $name}) RETURN properties(c) AS checkpoint",
+                 {"name": CHECKPOINT})
+    return rows[0]["checkpoint"] if rows else {}
+
+
+def throttle(elapsed, budget):
+    """ sleep so that elapsed seconds of queries stay a budget fraction of the time """
+    if 0 < budget < 1:
+        time.sleep(elapsed * (1.0 / budget - 1))
+
+
+def scan(budget=None, chunk_size=None):
+    """ scan from the checkpoint to the end of the pass, returns the number of issues found on the way """
+    budget = cmdb_config.CONSISTENCY_BUDGET if budget is None else budget
+    chunk_size = chunk_size or cmdb_config.CONSISTENCY_CHUNK_SIZE
+    by_label, edges, labels = rules(), declared(), sorted(models())
+
+    state = checkpoint()
+    label, after = state.get("label"), state.get("after") or ""
+    if label not in labels:
+        # a new pass
+        label, after = labels[0], ""
+        state["pass_started"] = int(time.time() * 1000)
+
+    found = 0
+    for index in range(labels.index(label), len(labels)):
+        label = labels[index]
+        while True:
+            started = time.perf_counter()
+            issues, last = check_chunk(models()[label], after, chunk_size, by_label.get(label, []), edges)
+            # the checkpoint is where the next chunk starts
+            if last is not None:
+                position = {"label": label, "after": last}
+            else:
+                position = {"label": labels[index + 1] if index + 1 < len(labels) else None, "after": ""}
+            _save(label, after, last, issues, dict(position, pass_started=state["pass_started"]))
+            found += len(issues)
+            throttle(time.perf_counter() - started, budget)
+            if last is None:
+                break
+            after = last
+        after = ""
+
+    query("MATCH (c:ConsistencyCheckpoint {name: $name}) "
+          "SET c.pass_finished = timestamp(), c.passes = coalesce(c.passes, 0) + 1",
+          {"name": CHECKPOINT})
+    return found
+
+
+def report(label=None, check=None, limit=DEFAULT_LIMIT):
+    """ GET /health/consistency: issue counts, the first limit issues and the progress of the scan """
+    where = " AND ".join(condition for condition, value in (("i.label = $label", label),
+                                                             ("i.check = $check", check)) if value)
+    where = " WHERE " + where if where else ""
+    params = {"label": label, "check": check, "limit": limit}
+    summary = query("MATCH (i:ConsistencyIssue)%s "
+                    "RETURN i.label AS label, i.check AS check, i.relation AS relation, count(*) AS nodes "
+                    "ORDER BY label, check, relation" % where, params)
+    issues = query("MATCH (i:ConsistencyIssue)%s "
+                   "RETURN properties(i) AS issue ORDER BY i.label, i.node_id LIMIT $limit" % where, params)
+
+    state = checkpoint()
+    return {"summary": summary,
+            "total": sum(row["nodes"] for row in summary),
+            "issues": [row["issue"] for row in issues],
+            "scan": {"label": state.get("label"), "after": state.get("after") or None,
+                     "pass_started": state.get("pass_started"), "pass_finished": state.get("pass_finished"),
+                     "passes": state.get("passes", 0)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["run", "once"])
+    parser.add_argument("--budget", type=float, help="fraction of time spent in queries, defaults to "
+                                                     "CONSISTENCY_BUDGET")
+    parser.add_argument("--chunk-size", type=int, help="nodes per query, defaults to CONSISTENCY_CHUNK_SIZE")
+    args = parser.parse_args()
+
+    import cmdb_metrics
+    import logging
+    import neomodel
+    cmdb_metrics.configure_logging()
+    neomodel.config.DATABASE_URL = cmdb_config.DB_URL
+
+    while True:
+        started = time.time()
+        found = scan(args.budget, args.chunk_size)
+        logging.info("consistency pass done in %.0fs, %d issues", time.time() - started, found)
+        if args.command == "once":
+            return 0
+        time.sleep(cmdb_config.CONSISTENCY_INTERVAL)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+#coding=utf-8
+"""
+ETags for the node and relationship GET routes
+
+for GET /<resource>/<id>[/<secondary>[/<secondary_id>]] the tag is computed
+from a version stamp: the stored properties of the node and, for the
+relationship routes, of the related nodes and relationships. the stamp is
+one indexed cypher lookup, so an If-None-Match request that matches is
+answered with 304 without the neomodel hydration (one query per related
+node in GRest) and without serializing a body.
+
+other GET responses get an ETag hashed from their body, which only saves
+the transfer.
+"""
+
+import hashlib
+import json
+
+from flask import Response
+
+from cmdb_graph import id_field, pattern, query, relation
+
+
+def stamp(view, primary_id, secondary_model_name=None, secondary_id=None):
+    """ version stamp of what GRest's get would return, None when there is nothing to return """
+    model = view.__model__["primary"]
+    match = "MATCH (n:%s {%s: $primary_id})" % (model.__label__, view.__selection_field__["primary"])
+
+    if secondary_model_name is None:
+        rows = query(match + " RETURN properties(n) AS node", {"primary_id": primary_id})
+        return rows[0]["node"] if rows else None
+
+    target = view.__model__.get("secondary", {}).get(secondary_model_name)
+    if target is None:
+        return None
+    try:
+        rel = relation(model, secondary_model_name, target)
+    except ValueError:
+        return None
+
+    where = " WHERE m.%s = $secondary_id" % id_field(target) if secondary_id is not None else ""
+    rows = query(match + " OPTIONAL MATCH " + pattern(rel) + where +
+                 " RETURN properties(n) AS node, collect([properties(m), properties(r)]) AS related",
+                 {"primary_id": primary_id, "secondary_id": secondary_id})
+    if not rows or not rows[0]["related"]:
+        return None
+    related = sorted(json.dumps(item, sort_keys=True, default=str) for item in rows[0]["related"])
+    return {"node": rows[0]["node"], "related": related}
+
+
+def etag(view, request, primary_id, secondary_model_name=None, secondary_id=None):
+    """ ETag of a GET request on a node (or its relationships), None when not found """
+    version = stamp(view, primary_id, secondary_model_name, secondary_id)
+    if version is None:
+        return None
+    digest = hashlib.sha1()
+    digest.update(request.full_path.encode("utf-8"))
+    digest.update(request.headers.get("Accept", "").encode("utf-8"))
+    digest.update(json.dumps(version, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def not_modified(tag):
+    response = Response(status=304)
+    response.set_etag(tag)
+    return response
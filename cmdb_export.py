@@ -0,0 +1,58 @@
+#coding=utf-8
+"""
+NDJSON export of a whole label
+
+the nodes are streamed from the neo4j result cursor and written out in
+chunks, optionally gzip compressed on the fly, so the memory used by a
+worker does not depend on the size of the label.
+"""
+
+import json
+import zlib
+
+from cmdb_graph import id_field, pattern, secondary_relations, stream
+from cmdb_projection import clean, projection
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _rows(view, relations=False, fields=None):
+    model = view.__model__["primary"]
+    columns = ["%s AS node" % projection("n", fields)]
+    if relations:
+        # first hop neighbours as lists of ids, one column per secondary name
+        for name, rel in secondary_relations(view).items():
+            columns.append("[%s | m.%s] AS `%s`" % (pattern(rel, var=""), id_field(rel.model), name))
+
+    return stream("MATCH (n:%s) RETURN %s" % (model.__label__, ", ".join(columns)))
+
+
+def export_lines(view, relations=False, fields=None):
+    """ one JSON document per node, each newline terminated """
+    model = view.__model__["primary"]
+    for row in _rows(view, relations, fields):
+        document = clean(row.pop("node"), model)
+        document.update(row)
+        yield json.dumps(document, separators=(",", ":")) + "\n"
+
+
+def chunks(lines, gzip=False, size=CHUNK_SIZE):
+    """ group lines into chunks of about size bytes, gzip compressed on request """
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+    buffer, buffered = [], 0
+    for line in lines:
+        data = line.encode("utf-8")
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= size:
+            chunk = b"".join(buffer)
+            buffer, buffered = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+
+    chunk = b"".join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
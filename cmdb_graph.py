@@ -0,0 +1,114 @@
+#coding=utf-8
+"""
+graph helpers shared by the cypher backed endpoints
+
+GRest only works on one label at a time through neomodel, the helpers below
+read the node and relationship definitions of cmdb_model so that views can
+build (parameterized) cypher queries over several labels at once.
+"""
+
+import os
+from collections import namedtuple
+
+import neomodel
+from neomodel import db, StructuredNode, UniqueIdProperty
+from neomodel.relationship_manager import OUTGOING
+
+import cmdb_model
+
+Relation = namedtuple("Relation", ["name", "type", "direction", "model", "properties"])
+
+
+def models():
+    """ all node models declared in cmdb_model, by label """
+    return {value.__label__: value for value in vars(cmdb_model).values()
+            if isinstance(value, type) and issubclass(value, StructuredNode)
+            and value.__module__ == cmdb_model.__name__}
+
+
+def properties(model):
+    """ node (or relationship) properties of a model, without relationships """
+    return model.defined_properties(aliases=False, rels=False)
+
+
+def id_field(model):
+    """ name of the UniqueIdProperty of a node model (app_id, host_id, ...) """
+    for name, prop in properties(model).items():
+        if isinstance(prop, UniqueIdProperty):
+            return name
+    raise ValueError("%s has no unique id property" % model.__name__)
+
+
+def _target_name(definition):
+    target = definition._raw_class
+    return target if isinstance(target, str) else target.__name__
+
+
+def relation(model, name, target):
+    """
+    resolve a secondary name of a view to a relationship of model
+
+    the secondary names don't always match the attribute names in cmdb_model
+    (e.g. HostView "app" is Host.app_depend), so when there is no attribute
+    called name the only relationship pointing at target is used instead.
+    """
+    definitions = model.defined_properties(aliases=False, properties=False)
+    definition = definitions.get(name)
+    if definition is None or _target_name(definition) != target.__name__:
+        candidates = [d for d in definitions.values() if _target_name(d) == target.__name__]
+        if len(candidates) != 1:
+            raise ValueError("%s has no single relationship to %s" % (model.__name__, target.__name__))
+        definition = candidates[0]
+
+    rel_type = definition.definition["relation_type"]
+    direction = definition.definition["direction"]
+    rel_model = definition.definition.get("model")
+    if rel_model is None:
+        # RelationshipFrom usually leaves the relationship model on the other side
+        for other in target.defined_properties(aliases=False, properties=False).values():
+            if all([other.definition["relation_type"] == rel_type,
+                    other.definition["direction"] == -direction,
+                    _target_name(other) == model.__name__,
+                    other.definition.get("model") is not None]):
+                rel_model = other.definition["model"]
+                break
+
+    return Relation(name, rel_type, direction, target,
+                    properties(rel_model) if rel_model is not None else {})
+
+
+def secondary_relations(view):
+    """ relations of a GRest view, keyed on the names in __model__["secondary"] """
+    primary = view.__model__["primary"]
+    return {name: relation(primary, name, target)
+            for name, target in view.__model__.get("secondary", {}).items()}
+
+
+def pattern(rel, source="n", target="m", var="r", label=True):
+    """
+    cypher pattern of a relation, e.g. (n)-[r:Depend_ON]->(m:Host)
+    label=False leaves out the target label when target is already bound
+    """
+    node = "(%s:%s)" % (target, rel.model.__label__) if label else "(%s)" % target
+    if rel.direction == OUTGOING:
+        return "(%s)-[%s:%s]->%s" % (source, var, rel.type, node)
+    return "(%s)<-[%s:%s]-%s" % (source, var, rel.type, node)
+
+
+def query(cypher, params=None):
+    """ run a cypher query and return the rows as dicts keyed on the RETURN columns """
+    results, meta = db.cypher_query(cypher, params or {})
+    return [dict(zip(meta, row)) for row in results]
+
+
+def stream(cypher, params=None):
+    """
+    like query, but yields the rows while the driver fetches them
+    instead of loading the whole result, for label-sized results
+    """
+    if not db.url or getattr(db, "_pid", None) != os.getpid():
+        db.set_connection(db.url or neomodel.config.DATABASE_URL)
+
+    with db.driver.session() as session:
+        for record in session.run(cypher, params or {}):
+            yield dict(zip(record.keys(), record.values()))
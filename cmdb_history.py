@@ -0,0 +1,418 @@
+#coding=utf-8
+"""
+point-in-time history of the graph
+
+the versions are kept next to the graph, under their own labels, so the
+current nodes, relationships and every read of them are untouched:
+    (:Version {_key: "App:<app_id>", _label, _from, _to, <properties of the node>})
+    (:EdgeVersion {_source: "App:<app_id>", _type: "Depend_ON", _target: "Host:<host_id>",
+                   _from, _to, <properties of the relationship>})
+_from / _to are epoch milliseconds, _to is null for the current version. a
+version is valid at t when _from <= t < _to.
+
+the versions are written from the change log (cmdb_changes observers), in the
+transaction that appends the changes: a node create / update snapshots the
+node, a delete closes it and its relationships, a connect / disconnect /
+replace syncs the intervals of that relationship with the graph.
+
+history starts when it is enabled, run once (nodes already versioned are skipped):
+    python cmdb_history.py init
+    python cmdb_history.py prune --days 365    drop the versions closed before that
+
+reads, see CMDBView.get and DiffView:
+    GET /v1/<resource>/<id>?as_of=<ts>                 the node at ts
+    GET /v1/<resource>/<id>/<secondary>?as_of=<ts>     its neighbours at ts
+    GET /v1/diff?from=<ts>&to=<ts>[&resource=app]      nodes and relationships changed in between
+ts is ISO 8601 (2020-06-02T10:00:00Z) or epoch seconds.
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+from inflection import pluralize, singularize
+from neomodel.relationship_manager import OUTGOING
+
+import cmdb_config
+from cmdb_graph import id_field, models, pattern, query, relation
+from cmdb_projection import clean
+
+NODE_META = ("_key", "_label", "_from", "_to")
+EDGE_META = ("_source", "_type", "_target", "_from", "_to")
+
+# (label, property, unique) indexes of the versions, created by cmdb_schema
+INDEXES = (("Version", "_key", False), ("Version", "_from", False), ("Version", "_to", False),
+           ("EdgeVersion", "_source", False), ("EdgeVersion", "_target", False),
+           ("EdgeVersion", "_from", False), ("EdgeVersion", "_to", False))
+
+MAX_DIFF = 10000
+BATCH_SIZE = 10000
+
+
+class DiffTooLarge(Exception):
+    """ too many versions changed in the interval of a diff """
+
+
+def parse_time(value):
+    """ epoch milliseconds of an ISO 8601 or epoch seconds argument, raises ValueError """
+    try:
+        return int(float(value) * 1000)
+    except (ValueError, OverflowError):
+        pass
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def format_time(ms):
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms / 1000.0, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _models():
+    """ node models by resource name (cmdb_changes.resource) """
+    return {model.__name__.lower(): model for model in models().values()}
+
+
+def _secondary(resource, name):
+    """ Relation of the secondary name of the view of resource (as in its urls), None when unknown """
+    # cmdb_view 导入本模块, 这里延迟导入
+    from cmdb_view import RESOURCES
+    for view in RESOURCES.values():
+        target = view.__model__.get("secondary", {}).get(name)
+        if target is not None and view.__model__["primary"].__name__.lower() == resource:
+            try:
+                return relation(view.__model__["primary"], name, target)
+            except ValueError:
+                return None
+    return None
+
+
+def key(model, node_id):
+    return "%s:%s" % (model.__label__, node_id)
+
+
+def _strip(document, meta):
+    return {name: value for name, value in document.items() if name not in meta}
+
+
+# writes
+
+def _version_nodes(model, ids, now):
+    query("UNWIND $ids AS id "
+          "MATCH (n:%s {%s: id}) "
+          "OPTIONAL MATCH (v:Version {_key: $prefix + id}) WHERE v._to IS NULL "
+          "SET v._to = $now "
+          "CREATE (w:Version) "
+          "SET w = properties(n), w._key = $prefix + id, w._label = $label, w._from = $now"
+          % (model.__label__, id_field(model)),
+          {"ids": ids, "prefix": model.__label__ + ":", "label": model.__label__, "now": now})
+
+
+def _close_nodes(model, ids, now):
+    """ close the versions of deleted nodes and of their relationships, ids None closes the label """
+    if ids is None:
+        query("MATCH (v:Version {_label: $label}) WHERE v._to IS NULL SET v._to = $now",
+              {"label": model.__label__, "now": now})
+        query("MATCH (e:EdgeVersion) WHERE e._to IS NULL "
+              "AND (e._source STARTS WITH $prefix OR e._target STARTS WITH $prefix) SET e._to = $now",
+              {"prefix": model.__label__ + ":", "now": now})
+        return
+    keys = [key(model, node_id) for node_id in ids]
+    query("UNWIND $keys AS key "
+          "MATCH (v:Version {_key: key}) WHERE v._to IS NULL SET v._to = $now",
+          {"keys": keys, "now": now})
+    for side in ("_source", "_target"):
+        query("UNWIND $keys AS key "
+              "MATCH (e:EdgeVersion {%s: key}) WHERE e._to IS NULL SET e._to = $now" % side,
+              {"keys": keys, "now": now})
+
+
+def _sync_edges(model, rel, ids, now):
+    """ open / close the relationship versions of rel of the ids nodes to match the graph """
+    outgoing = rel.direction == OUTGOING
+    side, other = ("_source", "_target") if outgoing else ("_target", "_source")
+    current = query("UNWIND $ids AS id "
+                    "MATCH (n:%s {%s: id}) "
+                    "MATCH %s "
+                    "RETURN id, m.%s AS other, properties(r) AS properties"
+                    % (model.__label__, id_field(model), pattern(rel), id_field(rel.model)),
+                    {"ids": ids})
+    opened = query("UNWIND $keys AS key "
+                   "MATCH (e:EdgeVersion {%s: key}) "
+                   "WHERE e._to IS NULL AND e._type = $type AND e.%s STARTS WITH $prefix "
+                   "RETURN e.%s AS key, e.%s AS other, properties(e) AS properties"
+                   % (side, other, side, other),
+                   {"keys": [key(model, node_id) for node_id in ids], "type": rel.type,
+                    "prefix": rel.model.__label__ + ":"})
+
+    wanted = {(key(model, row["id"]), key(rel.model, row["other"])): row["properties"] for row in current}
+    found = {(row["key"], row["other"]): _strip(row["properties"], EDGE_META) for row in opened}
+    closed = [pair for pair in found if wanted.get(pair) != found[pair]]
+    added = [pair for pair in wanted if found.get(pair) != wanted[pair]]
+
+    def edge(pair):
+        return pair if outgoing else (pair[1], pair[0])
+
+    if closed:
+        query("UNWIND $edges AS edge "
+              "MATCH (e:EdgeVersion {_source: edge[0]}) "
+              "WHERE e._target = edge[1] AND e._type = $type AND e._to IS NULL "
+              "SET e._to = $now",
+              {"edges": [edge(pair) for pair in closed], "type": rel.type, "now": now})
+    if added:
+        query("UNWIND $edges AS edge "
+              "CREATE (e:EdgeVersion) "
+              "SET e = edge.properties, e._source = edge.source, e._target = edge.target, "
+              "e._type = $type, e._from = $now",
+              {"edges": [{"source": edge(pair)[0], "target": edge(pair)[1], "properties": wanted[pair]}
+                         for pair in added], "type": rel.type, "now": now})
+
+
+def record(changes):
+    """ version what changes wrote, in the current transaction (a cmdb_changes observer) """
+    if not cmdb_config.HISTORY:
+        return
+    by_resource, now = _models(), int(time.time() * 1000)
+    deleted, written, linked = {}, {}, {}
+    for change in changes:
+        model = by_resource.get(change["resource"])
+        if model is None:
+            continue
+        if change["op"] == "delete":
+            ids = deleted.setdefault(model, set())
+            if change["id"] is None:
+                deleted[model] = None
+            elif ids is not None:
+                ids.add(change["id"])
+        elif change["op"] in ("create", "update"):
+            written.setdefault(model, set()).add(change["id"])
+        else:
+            rel = _secondary(change["resource"], change["relation"])
+            if rel is not None:
+                linked.setdefault((model, change["relation"]), (rel, set()))[1].add(change["id"])
+
+    # 先关闭被删除的节点 (PUT 先删除再创建同一个 id)
+    for model, ids in deleted.items():
+        _close_nodes(model, sorted(ids) if ids is not None else None, now)
+    for model, ids in written.items():
+        _version_nodes(model, sorted(ids), now)
+    for (model, _), (rel, ids) in linked.items():
+        _sync_edges(model, rel, sorted(ids), now)
+
+
+# reads
+
+def node_as_of(view, primary_id, at):
+    """ GET /<resource>/<id>?as_of=, None when the node did not exist at """
+    model = view.__model__["primary"]
+    rows = query("MATCH (v:Version {_key: $key}) "
+                 "WHERE v._from <= $at AND coalesce(v._to, $at + 1) > $at "
+                 "RETURN properties(v) AS version",
+                 {"key": key(model, primary_id), "at": at})
+    if not rows:
+        return None
+    version = rows[0]["version"]
+    return {model.__name__.lower(): clean(version, model), "as_of": format_time(at),
+            "valid_from": format_time(version["_from"]), "valid_to": format_time(version.get("_to"))}
+
+
+def related_as_of(view, primary_id, name, at, secondary_id=None):
+    """ GET /<resource>/<id>/<secondary>[/<secondary_id>]?as_of=, None when the node did not exist at """
+    model = view.__model__["primary"]
+    target = view.__model__["secondary"][name]
+    rel = relation(model, name, target)
+    side, other = ("_source", "_target") if rel.direction == OUTGOING else ("_target", "_source")
+    where = " AND e.%s = $other" % other if secondary_id is not None else " AND e.%s STARTS WITH $prefix" % other
+    rows = query("MATCH (n:Version {_key: $key}) "
+                 "WHERE n._from <= $at AND coalesce(n._to, $at + 1) > $at "
+                 "OPTIONAL MATCH (e:EdgeVersion {%s: $key}) "
+                 "WHERE e._type = $type AND e._from <= $at AND coalesce(e._to, $at + 1) > $at%s "
+                 "OPTIONAL MATCH (m:Version {_key: e.%s}) "
+                 "WHERE m._from <= $at AND coalesce(m._to, $at + 1) > $at "
+                 "RETURN n._key AS node, "
+                 "collect(CASE WHEN m IS NULL THEN NULL ELSE [properties(m), properties(e)] END) AS related"
+                 % (side, where, other),
+                 {"key": key(model, primary_id), "at": at, "type": rel.type,
+                  "prefix": target.__label__ + ":",
+                  "other": key(target, secondary_id) if secondary_id is not None else None})
+    if not rows:
+        return None
+
+    items = []
+    for document, edge in rows[0]["related"]:
+        item = clean(document, target)
+        if _strip(edge, EDGE_META):
+            item["relationship"] = _strip(edge, EDGE_META)
+        items.append(item)
+    if secondary_id is not None:
+        return {singularize(name): items[0] if items else None, "as_of": format_time(at)}
+    return {pluralize(name): items or None, "as_of": format_time(at)}
+
+
+def _changed(label, meta, since, until, where, params, keys):
+    """ keys of the versions of label opened or closed in (since, until] """
+    rows = query("CALL { "
+                 "MATCH (v:%s) WHERE v._from > $since AND v._from <= $until%s RETURN %s AS key "
+                 "UNION "
+                 "MATCH (v:%s) WHERE v._to > $since AND v._to <= $until%s RETURN %s AS key "
+                 "} RETURN key LIMIT $limit"
+                 % (label, where, keys, label, where, keys),
+                 dict(params, since=since, until=until, limit=MAX_DIFF + 1))
+    if len(rows) > MAX_DIFF:
+        raise DiffTooLarge("More than %d %s changed, narrow the interval" % (MAX_DIFF, meta))
+    return [row["key"] for row in rows]
+
+
+def diff(since, until, resources=None):
+    """
+    nodes and relationships added, removed and changed between since and until,
+    the versions valid at both instants compared
+    """
+    by_resource = _models()
+    labels = sorted(by_resource[name].__label__ for name in resources) if resources else None
+    where = " AND v._label IN $labels" if labels else ""
+    edge_where = (" AND (any(label IN $labels WHERE v._source STARTS WITH label + ':') "
+                  "OR any(label IN $labels WHERE v._target STARTS WITH label + ':'))") if labels else ""
+    params = {"labels": labels}
+
+    node_keys = _changed("Version", "nodes", since, until, where, params, "v._key")
+    rows = query("UNWIND $keys AS key "
+                 "OPTIONAL MATCH (a:Version {_key: key}) "
+                 "WHERE a._from <= $since AND coalesce(a._to, $since + 1) > $since "
+                 "OPTIONAL MATCH (b:Version {_key: key}) "
+                 "WHERE b._from <= $until AND coalesce(b._to, $until + 1) > $until "
+                 "RETURN key, properties(a) AS before, properties(b) AS after",
+                 {"keys": node_keys, "since": since, "until": until})
+    nodes = _compare(rows, NODE_META, lambda row: {"key": row["key"]})
+
+    edge_keys = _changed("EdgeVersion", "relationships", since, until, edge_where, params,
+                         "[v._source, v._type, v._target]")
+    rows = query("UNWIND $keys AS key "
+                 "OPTIONAL MATCH (a:EdgeVersion {_source: key[0]}) "
+                 "WHERE a._type = key[1] AND a._target = key[2] "
+                 "AND a._from <= $since AND coalesce(a._to, $since + 1) > $since "
+                 "OPTIONAL MATCH (b:EdgeVersion {_source: key[0]}) "
+                 "WHERE b._type = key[1] AND b._target = key[2] "
+                 "AND b._from <= $until AND coalesce(b._to, $until + 1) > $until "
+                 "RETURN key, properties(a) AS before, properties(b) AS after",
+                 {"keys": edge_keys, "since": since, "until": until})
+    edges = _compare(rows, EDGE_META,
+                     lambda row: {"source": row["key"][0], "type": row["key"][1], "target": row["key"][2]})
+
+    return {"from": format_time(since), "to": format_time(until), "nodes": nodes, "relationships": edges}
+
+
+def _compare(rows, meta, describe):
+    result = {"added": [], "removed": [], "changed": []}
+    for row in sorted(rows, key=lambda row: json.dumps(row["key"])):
+        before = _strip(row["before"], meta) if row["before"] is not None else None
+        after = _strip(row["after"], meta) if row["after"] is not None else None
+        if before == after:
+            continue
+        item = describe(row)
+        if before is None:
+            item["properties"] = after
+            result["added"].append(item)
+        elif after is None:
+            item["properties"] = before
+            result["removed"].append(item)
+        else:
+            item["before"], item["after"] = before, after
+            result["changed"].append(item)
+    return result
+
+
+# management
+
+def _edge_relations():
+    """ every relationship (source model, Relation) once, from its outgoing side """
+    edges = {}
+    for model in models().values():
+        for name, definition in model.defined_properties(aliases=False, properties=False).items():
+            if definition.definition["direction"] != OUTGOING:
+                continue
+            target = definition._raw_class
+            target = models().get(target if isinstance(target, str) else target.__name__)
+            if target is not None:
+                rel = relation(model, name, target)
+                edges[(model.__label__, rel.type, target.__label__)] = (model, rel)
+    return [edges[edge] for edge in sorted(edges)]
+
+
+def init(stdout=sys.stdout):
+    """ open a version for every node and relationship that has none """
+    now = int(time.time() * 1000)
+    for label, model in sorted(models().items()):
+        total = 0
+        while True:
+            rows = query("MATCH (n:%s) "
+                         "WHERE NOT EXISTS { MATCH (v:Version {_key: $prefix + n.%s}) WHERE v._to IS NULL } "
+                         "WITH n LIMIT $batch "
+                         "CREATE (w:Version) "
+                         "SET w = properties(n), w._key = $prefix + n.%s, w._label = $label, w._from = $now "
+                         "RETURN count(w) AS created"
+                         % (label, id_field(model), id_field(model)),
+                         {"prefix": label + ":", "label": label, "now": now, "batch": BATCH_SIZE})
+            total += rows[0]["created"]
+            if rows[0]["created"] < BATCH_SIZE:
+                break
+        stdout.write("%s: %d versions\n" % (label, total))
+
+    for model, rel in _edge_relations():
+        total = 0
+        while True:
+            rows = query("MATCH (n:%s)-[r:%s]->(m:%s) "
+                         "WITH n, r, m, $source + n.%s AS source, $target + m.%s AS target "
+                         "WHERE NOT EXISTS { MATCH (e:EdgeVersion {_source: source}) "
+                         "WHERE e._type = $type AND e._target = target AND e._to IS NULL } "
+                         "WITH r, source, target LIMIT $batch "
+                         "CREATE (e:EdgeVersion) "
+                         "SET e = properties(r), e._source = source, e._target = target, "
+                         "e._type = $type, e._from = $now "
+                         "RETURN count(e) AS created"
+                         % (model.__label__, rel.type, rel.model.__label__, id_field(model), id_field(rel.model)),
+                         {"source": model.__label__ + ":", "target": rel.model.__label__ + ":",
+                          "type": rel.type, "now": now, "batch": BATCH_SIZE})
+            total += rows[0]["created"]
+            if rows[0]["created"] < BATCH_SIZE:
+                break
+        stdout.write("(%s)-[%s]->(%s): %d versions\n" % (model.__label__, rel.type, rel.model.__label__, total))
+
+
+def prune(days):
+    """ drop the versions closed more than days ago, returns how many """
+    cutoff = int((time.time() - days * 86400) * 1000)
+    total = 0
+    for label in ("Version", "EdgeVersion"):
+        while True:
+            rows = query("MATCH (v:%s) WHERE v._to < $cutoff WITH v LIMIT $batch DELETE v "
+                         "RETURN count(*) AS deleted" % label,
+                         {"cutoff": cutoff, "batch": BATCH_SIZE})
+            total += rows[0]["deleted"]
+            if rows[0]["deleted"] < BATCH_SIZE:
+                break
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["init", "prune"])
+    parser.add_argument("--days", type=int, default=365, help="prune: closed versions kept")
+    args = parser.parse_args()
+
+    import neomodel
+    neomodel.config.DATABASE_URL = cmdb_config.DB_URL
+    if args.command == "init":
+        init()
+    else:
+        print("pruned %d versions" % prune(args.days))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
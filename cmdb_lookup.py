@@ -0,0 +1,45 @@
+#coding=utf-8
+"""
+lookups by natural keys (ip, host name, app name) instead of the *_id uuids
+
+a view declares its keys in __natural_keys__, key -> properties matched:
+    __natural_keys__ = {"ip": ("private_ip", "public_ip"), "name": ("host_name",)}
+every matched property is indexed (cmdb_model, index=True). one key resolves to
+a list of nodes since natural keys are not unique.
+
+a batch of keys is resolved with one UNWIND query, one UNION branch per
+property so that each branch is an index seek (an OR of properties is not).
+"""
+
+from cmdb_graph import query
+from cmdb_projection import clean, projection
+
+MAX_KEYS = 10000
+
+
+def read_keys(request):
+    """ keys of a batch body, a JSON array or {"keys": [...]}, raises ValueError """
+    body = request.get_json(silent=True)
+    keys = body.get("keys") if isinstance(body, dict) else body
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        raise ValueError("Expecting a JSON array of strings")
+    if len(keys) > MAX_KEYS:
+        raise ValueError("At most %d keys" % MAX_KEYS)
+    return keys
+
+
+def lookup(view, key, values, fields=None):
+    """ {value: [nodes]} of the nodes of view whose key properties match values """
+    model = view.__model__["primary"]
+    props = view.__natural_keys__[key]
+    values = list(dict.fromkeys(values))
+    branches = ["UNWIND $values AS value "
+                "MATCH (n:%s) WHERE n.%s = value "
+                "RETURN value, %s AS node" % (model.__label__, prop, projection("n", fields))
+                for prop in props]
+    rows = query(" UNION ".join(branches), {"values": values})
+
+    results = {value: [] for value in values}
+    for row in rows:
+        results[row["value"]].append(clean(row["node"], model))
+    return results
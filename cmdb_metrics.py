@@ -0,0 +1,201 @@
+#coding=utf-8
+"""
+request instrumentation: Prometheus metrics on /metrics and JSON logs
+
+for every request: latency per route, the number of cypher queries run
+through neomodel (db.cypher_query) and of rows they fetched, the time spent
+in those queries and in JSON serialization. the Bolt pool of the process is
+sampled on every scrape.
+
+every request gets an id (X-Request-ID, generated when the client sends none),
+returned in the response headers and written in every log line of the request.
+
+the metrics are kept per process: with several gunicorn workers each scrape
+reaches one worker, the pid label tells them apart.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from uuid import uuid4
+
+from flask import Response, g, has_request_context, request
+from neomodel.util import Database
+
+import cmdb_config
+import cmdb_driver
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram(object):
+    """ prometheus histogram with labels """
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def lines(self):
+        yield "# HELP %s %s" % (self.name, self.documentation)
+        yield "# TYPE %s histogram" % self.name
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in sorted(series):
+            for bound, bucket in zip(self.buckets, counts):
+                yield "%s_bucket%s %d" % (self.name, _labels(key + (("le", repr(float(bound))),)), bucket)
+            yield "%s_bucket%s %d" % (self.name, _labels(key + (("le", "+Inf"),)), count)
+            yield "%s_sum%s %r" % (self.name, _labels(key), total)
+            yield "%s_count%s %d" % (self.name, _labels(key), count)
+
+
+def _labels(items):
+    items = (("pid", str(os.getpid())),) + tuple(items)
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in items)
+
+
+REQUEST_LATENCY = Histogram("cmdb_request_duration_seconds", "Request latency per route", LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram("cmdb_request_cypher_queries", "Cypher queries run per request", COUNT_BUCKETS)
+REQUEST_ROWS = Histogram("cmdb_request_cypher_rows", "Rows fetched by the cypher queries of a request", ROW_BUCKETS)
+QUERY_LATENCY = Histogram("cmdb_cypher_query_duration_seconds", "Cypher query latency", LATENCY_BUCKETS)
+SERIALIZATION = Histogram("cmdb_serialization_duration_seconds", "JSON serialization time per request",
+                          LATENCY_BUCKETS)
+
+HISTOGRAMS = (REQUEST_LATENCY, REQUEST_QUERIES, REQUEST_ROWS, QUERY_LATENCY, SERIALIZATION)
+
+
+def pool_lines():
+    """ Bolt pool gauges of the shared driver of this process """
+    pool = getattr(cmdb_driver._driver, "_pool", None) if cmdb_driver._driver_pid == os.getpid() else None
+    in_use = idle = 0
+    if pool is not None:
+        for address in list(getattr(pool, "connections", {})):
+            used = pool.in_use_connection_count(address)
+            in_use += used
+            idle += len(pool.connections.get(address, ())) - used
+    yield "# HELP cmdb_bolt_pool_connections Bolt connections of the process by state"
+    yield "# TYPE cmdb_bolt_pool_connections gauge"
+    yield "cmdb_bolt_pool_connections%s %d" % (_labels((("state", "in_use"),)), in_use)
+    yield "cmdb_bolt_pool_connections%s %d" % (_labels((("state", "idle"),)), idle)
+    yield "# HELP cmdb_bolt_pool_max_connections Bolt pool size of the process"
+    yield "# TYPE cmdb_bolt_pool_max_connections gauge"
+    yield "cmdb_bolt_pool_max_connections%s %d" % (_labels(()), cmdb_config.BOLT_MAX_CONNECTION_POOL_SIZE)
+
+
+def exposition():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.lines())
+    lines.extend(pool_lines())
+    return "\n".join(lines) + "\n"
+
+
+# 包装 neomodel 的 db.cypher_query, 统计每个请求的查询次数和返回行数
+_cypher_query = Database.cypher_query
+
+# observer(db, query, params, elapsed seconds, rows) called after every query (see cmdb_profile)
+QUERY_OBSERVERS = []
+
+
+def _timed_cypher_query(self, query, params=None, *args, **kwargs):
+    started = time.perf_counter()
+    results, meta = _cypher_query(self, query, params, *args, **kwargs)
+    elapsed = time.perf_counter() - started
+    QUERY_LATENCY.observe(elapsed)
+    if has_request_context() and "queries" in g:
+        g.queries += 1
+        g.rows += len(results)
+        g.query_time += elapsed
+    for observer in QUERY_OBSERVERS:
+        observer(self, query, params, elapsed, len(results))
+    return results, meta
+
+
+def _timed_json_provider(provider_class):
+    class TimedJSONProvider(provider_class):
+        def dumps(self, obj, **kwargs):
+            started = time.perf_counter()
+            try:
+                return super(TimedJSONProvider, self).dumps(obj, **kwargs)
+            finally:
+                if has_request_context() and "serialization_time" in g:
+                    g.serialization_time += time.perf_counter() - started
+    return TimedJSONProvider
+
+
+class JSONFormatter(logging.Formatter):
+    """ one JSON object per log line, with the id of the current request """
+
+    def format(self, record):
+        document = {"time": self.formatTime(record), "level": record.levelname,
+                    "logger": record.name, "message": record.getMessage()}
+        if has_request_context() and "request_id" in g:
+            document["request_id"] = g.request_id
+        document.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+def configure_logging():
+    handler = logging.FileHandler(cmdb_config.LOG_FILE) if cmdb_config.LOG_FILE else logging.StreamHandler()
+    handler.setFormatter(JSONFormatter())
+    logging.basicConfig(level=cmdb_config.LOG_LEVEL, handlers=[handler])
+
+
+def _start():
+    g.request_id = request.headers.get("X-Request-ID") or uuid4().hex
+    g.started = time.perf_counter()
+    g.queries, g.rows, g.query_time, g.serialization_time = 0, 0, 0.0, 0.0
+
+
+def _finish(response):
+    if "started" not in g:
+        return response
+    elapsed = time.perf_counter() - g.started
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    labels = {"method": request.method, "route": route}
+    REQUEST_LATENCY.observe(elapsed, status=str(response.status_code), **labels)
+    REQUEST_QUERIES.observe(g.queries, **labels)
+    REQUEST_ROWS.observe(g.rows, **labels)
+    SERIALIZATION.observe(g.serialization_time, **labels)
+
+    response.headers["X-Request-ID"] = g.request_id
+    logging.getLogger("cmdb.request").info("request", extra={"fields": {
+        "method": request.method, "path": request.full_path.rstrip("?"), "route": route,
+        "status": response.status_code, "duration_ms": round(elapsed * 1000, 3),
+        "queries": g.queries, "rows": g.rows, "query_ms": round(g.query_time * 1000, 3),
+        "serialization_ms": round(g.serialization_time * 1000, 3)}})
+    return response
+
+
+def init_app(app):
+    """ instrument app and serve /metrics """
+    Database.cypher_query = _timed_cypher_query
+    if hasattr(app, "json_provider_class"):
+        app.json_provider_class = _timed_json_provider(app.json_provider_class)
+        app.json = app.json_provider_class(app)
+
+    app.before_request(_start)
+    app.after_request(_finish)
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(exposition(), mimetype="text/plain; version=0.0.4")
@@ -23,7 +23,7 @@ class Environment(StructuredNode, models.Node):
     8. (Person)-[Manage_TO]->(Environment)
     """
     environment_id = UniqueIdProperty()
-    environment_name = StringProperty()
+    environment_name = StringProperty(index=True)
     environment_status = StringProperty()
 
     app_belong = RelationshipFrom("App", "Belong_TO")
@@ -66,9 +66,9 @@ class Host(StructuredNode, models.Node):
     4. (MD)-[Depend_ON]->(host)
     """
     host_id = UniqueIdProperty()
-    host_name = StringProperty()
-    private_ip = StringProperty()
-    public_ip = StringProperty()
+    host_name = StringProperty(index=True)
+    private_ip = StringProperty(index=True)
+    public_ip = StringProperty(index=True)
     CPU = StringProperty()
     memory = StringProperty()
     OS = StringProperty()
@@ -293,7 +293,7 @@ class App(StructuredNode, models.Node):
     10. (person)-[Manager_TO]->(app)
     """
     app_id = UniqueIdProperty()
-    app_name = StringProperty()
+    app_name = StringProperty(index=True)
     code_git_path = StringProperty()
     CD_path = StringProperty()
     port = IntegerProperty()
@@ -0,0 +1,55 @@
+#coding=utf-8
+"""
+keyset (cursor) paging for the list endpoints
+
+GRest pages with skip/limit, which makes neo4j walk every skipped node. here
+the nodes are ordered on the selection field of the view (app_id, host_id, ...)
+and a page starts right after the last id of the previous one, so that the
+unique index on that field serves every page at the same cost.
+
+the cursor handed to clients is opaque: urlsafe base64 of [field, last id].
+"""
+
+import base64
+import json
+
+from cmdb_graph import query
+from cmdb_projection import clean, projection
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 1000
+
+
+def encode_cursor(field, last_id):
+    return base64.urlsafe_b64encode(json.dumps([field, last_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(field, cursor):
+    """ last id encoded in cursor ("" for the first page), raises ValueError on a foreign cursor """
+    if not cursor:
+        return ""
+    try:
+        cursor_field, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_field != field or not isinstance(last_id, str):
+        raise ValueError("Invalid cursor")
+    return last_id
+
+
+def page(model, field, cursor=None, limit=DEFAULT_LIMIT, fields=None, includes=()):
+    """
+    returns (items, next_cursor), next_cursor is None on the last page
+    fields and includes shape the returned nodes (see cmdb_projection)
+    """
+    after = decode_cursor(field, cursor)
+    if fields is not None and field not in fields:
+        fields = [field] + fields
+    rows = query("MATCH (n:%s) WHERE n.%s > $after "
+                 "RETURN %s AS node "
+                 "ORDER BY n.%s LIMIT $limit" % (model.__label__, field, projection("n", fields, includes), field),
+                 {"after": after, "limit": limit + 1})
+
+    items = [clean(row["node"], model, includes) for row in rows[:limit]]
+    next_cursor = encode_cursor(field, items[-1][field]) if len(rows) > limit else None
+    return items, next_cursor
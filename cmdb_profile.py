@@ -0,0 +1,107 @@
+#coding=utf-8
+"""
+slow-query log and per request cypher profiling
+
+every cypher statement run through neomodel (see cmdb_metrics) that takes
+longer than SLOW_QUERY_MS is written to the "cmdb.slow_query" log with its
+parameters, duration and rows, and the id of the request that ran it.
+
+with PROFILING on (debug only), ?_profile=1 on any route returns, next to the
+JSON response, every statement the request ran and its plan:
+    {..., "_profile": {"statements": [{"statement": ..., "parameters": ...,
+                                       "duration_ms": ..., "rows": ..., "plan": {...}}]}}
+the plan of a GET statement is a PROFILE of it, run again once the request got
+its result (reads only); the plan of a write is an EXPLAIN, nothing runs twice.
+profiled requests skip the GET cache.
+"""
+
+import json
+import logging
+
+from flask import g, has_request_context, request
+
+import cmdb_config
+import cmdb_metrics
+
+MAX_PARAMETERS_LENGTH = 2000
+
+slow_log = logging.getLogger("cmdb.slow_query")
+
+
+def _parameters(params):
+    """ parameters as logged, long ones (UNWIND batches) cut """
+    text = json.dumps(params or {}, default=str)
+    if len(text) > MAX_PARAMETERS_LENGTH:
+        return text[:MAX_PARAMETERS_LENGTH] + "..."
+    return text
+
+
+def _plan(plan):
+    """ operator tree of a PROFILE / EXPLAIN summary """
+    if not plan:
+        return None
+    args = plan.get("args", {})
+    node = {"operator": plan.get("operatorType"),
+            "details": args.get("Details"),
+            "estimated_rows": args.get("EstimatedRows")}
+    if "rows" in plan:
+        node["rows"] = plan.get("rows")
+        node["db_hits"] = plan.get("dbHits")
+    node["children"] = [_plan(child) for child in plan.get("children", [])]
+    return node
+
+
+def plan(database, query, params, read):
+    with database.driver.session() as session:
+        summary = session.run(("PROFILE " if read else "EXPLAIN ") + query, params or {}).consume()
+    return _plan(summary.profile if read else summary.plan)
+
+
+def observe(database, query, params, elapsed, rows):
+    """ query observer of cmdb_metrics """
+    duration_ms = round(elapsed * 1000, 3)
+    if cmdb_config.SLOW_QUERY_MS and duration_ms >= cmdb_config.SLOW_QUERY_MS:
+        slow_log.warning("slow query", extra={"fields": {
+            "statement": query, "parameters": _parameters(params), "duration_ms": duration_ms, "rows": rows,
+            "route": request.url_rule.rule if has_request_context() and request.url_rule else None}})
+
+    if has_request_context() and g.get("profile"):
+        statement = {"statement": query, "parameters": _parameters(params),
+                     "duration_ms": duration_ms, "rows": rows}
+        try:
+            statement["plan"] = plan(database, query, params, request.method == "GET")
+        except Exception as e:
+            statement["plan"] = None
+            statement["errors"] = [str(e)]
+        g.statements.append(statement)
+
+
+def profiled(request):
+    return cmdb_config.PROFILING and request.args.get("_profile", "").lower() in ("1", "true", "yes")
+
+
+def _start():
+    g.profile = profiled(request)
+    g.statements = []
+
+
+def _attach(response):
+    if not g.get("profile") or response.is_streamed or response.mimetype != "application/json":
+        return response
+    try:
+        document = json.loads(response.get_data(as_text=True))
+    except ValueError:
+        return response
+    if isinstance(document, dict):
+        document["_profile"] = {"statements": g.statements,
+                                "total_ms": round(sum(s["duration_ms"] for s in g.statements), 3)}
+        response.set_data(json.dumps(document))
+    return response
+
+
+def init_app(app):
+    # 每次 cmdb_api() 都会调用, 观察者只注册一次
+    if observe not in cmdb_metrics.QUERY_OBSERVERS:
+        cmdb_metrics.QUERY_OBSERVERS.append(observe)
+    app.before_request(_start)
+    app.after_request(_attach)
@@ -0,0 +1,223 @@
+#coding=utf-8
+"""
+field projection (sparse fieldsets) for the GET routes
+
+?fields=app_name,run_status selects the properties of the returned nodes and
+fields[<secondary>]=... those of embedded neighbours. the selection is pushed
+down into the RETURN clause as a map projection (n {.app_name, .run_status}),
+so the unused properties are neither fetched nor serialized. the selection
+field (app_id, ...) is always returned.
+
+?include=environment,host,databaseconnect.db embeds the listed neighbours
+(dotted names follow the secondary names of the next view) into every
+returned node, through nested pattern comprehensions of the same RETURN, so
+a page of nodes with its neighbours is still one query.
+
+the queries below answer the same routes as GRest (and in the same shape) when
+a projection or an include is requested.
+"""
+
+import re
+from collections import namedtuple
+
+from inflection import pluralize, singularize
+
+from cmdb_graph import id_field, pattern, properties, query, relation
+
+NEIGHBOUR_FIELDS = re.compile(r"^fields\[([\w.]+)\]$")
+
+MAX_INCLUDES = 10
+MAX_INCLUDE_DEPTH = 3
+
+Include = namedtuple("Include", ["name", "relation", "fields", "children"])
+
+
+def parse_fields(model, value):
+    """ property names listed in a fields argument (None when not given) """
+    if value is None:
+        return None
+    fields = properties(model)
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        raise ValueError("Unknown properties: %s" % ", ".join(unknown))
+    key = id_field(model)
+    return [key] + [name for name in names if name != key]
+
+
+def neighbour_fields(args):
+    """ {secondary name: raw fields value} of the fields[<secondary>] arguments """
+    fields = {}
+    for key, value in args.items():
+        match = NEIGHBOUR_FIELDS.match(key)
+        if match:
+            fields[match.group(1)] = value
+    return fields
+
+
+def parse_includes(view, value, views, fields=None):
+    """
+    tree of Include of an include argument (empty when not given)
+    views maps the node models to their views, to resolve dotted names;
+    fields are the fields[<dotted name>] arguments of the included nodes
+    """
+    if not value:
+        return ()
+    fields = fields or {}
+    paths = [path.strip() for path in value.split(",") if path.strip()]
+    if len(paths) > MAX_INCLUDES:
+        raise ValueError("Too many includes")
+
+    tree = {}
+    for path in paths:
+        names = path.split(".")
+        if len(names) > MAX_INCLUDE_DEPTH:
+            raise ValueError("Include %s is too deep" % path)
+        branch = tree
+        for name in names:
+            branch = branch.setdefault(name, {})
+
+    def build(source_view, branch, prefix):
+        includes = []
+        for name, children in sorted(branch.items()):
+            target = source_view.__model__.get("secondary", {}).get(name) if source_view else None
+            if target is None:
+                raise ValueError("Unknown include: %s" % (prefix + name))
+            rel = relation(source_view.__model__["primary"], name, target)
+            includes.append(Include(name, rel, parse_fields(target, fields.get(prefix + name)),
+                                    build(views.get(target), children, prefix + name + ".")))
+        return tuple(includes)
+
+    return build(view, tree, "")
+
+
+def projection(var, fields, includes=(), extra=()):
+    """
+    RETURN expression of a node variable, restricted to fields when given,
+    with the included neighbours as nested lists
+    """
+    if fields is None and not includes and not extra:
+        return "properties(%s)" % var
+
+    items = [".%s" % name for name in fields] if fields is not None else [".*"]
+    items.extend(extra)
+    for index, include in enumerate(includes):
+        target, rel_var = "%s_%d" % (var, index), "%s_r%d" % (var, index)
+        items.append("`%s`: [%s | %s]" % (
+            include.name, pattern(include.relation, source=var, target=target, var=rel_var),
+            projection(target, include.fields, include.children,
+                       ["relationship: properties(%s)" % rel_var])))
+    return "%s {%s}" % (var, ", ".join(items))
+
+
+def clean(document, model, includes=()):
+    """ drop null and undeclared properties, like models.Node.to_dict() """
+    fields = properties(model)
+    result = {key: value for key, value in document.items() if key in fields and value is not None}
+    if document.get("relationship"):
+        result["relationship"] = document["relationship"]
+    for include in includes:
+        result[include.name] = [clean(item, include.relation.model, include.children)
+                                for item in document.get(include.name) or []]
+    return result
+
+
+def nodes(model, fields, skip=0, limit=20, order_by=None, includes=()):
+    """ projected page of a label (GRest index with skip/limit/order_by) """
+    order = ""
+    if order_by:
+        prop = order_by.lstrip("-")
+        if prop not in properties(model):
+            raise ValueError("Unknown order property: %s" % prop)
+        order = " ORDER BY n.%s%s" % (prop, " DESC" if order_by.startswith("-") else "")
+
+    rows = query("MATCH (n:%s) RETURN %s AS node%s SKIP $skip LIMIT $limit"
+                 % (model.__label__, projection("n", fields, includes), order),
+                 {"skip": skip, "limit": limit})
+    return {pluralize(model.__name__.lower()): [clean(row["node"], model, includes) for row in rows]}
+
+
+def node_query(view, primary_id, fields=None, includes=()):
+    """ (cypher, params) of a projected GET /<resource>/<id> """
+    model = view.__model__["primary"]
+    return ("MATCH (n:%s {%s: $primary_id}) RETURN %s AS node"
+            % (model.__label__, view.__selection_field__["primary"], projection("n", fields, includes)),
+            {"primary_id": primary_id})
+
+
+def node_document(view, rows, includes=()):
+    model = view.__model__["primary"]
+    if not rows:
+        return None
+    return {model.__name__.lower(): clean(rows[0]["node"], model, includes)}
+
+
+def node(view, primary_id, fields, includes=()):
+    """ projected GET /<resource>/<id>, None when the node does not exist """
+    return node_document(view, query(*node_query(view, primary_id, fields, includes)), includes)
+
+
+def related_query(view, primary_id, name, fields=None, secondary_id=None):
+    """ (cypher, params) of a projected GET /<resource>/<id>/<secondary>[/<secondary_id>] """
+    model = view.__model__["primary"]
+    target = view.__model__["secondary"][name]
+    rel = relation(model, name, target)
+
+    where = " WHERE m.%s = $secondary_id" % id_field(target) if secondary_id is not None else ""
+    return ("MATCH (n:%s {%s: $primary_id}) "
+            "OPTIONAL MATCH %s%s "
+            "RETURN id(n) AS node, "
+            "collect(CASE WHEN m IS NULL THEN NULL ELSE [%s, properties(r)] END) AS related"
+            % (model.__label__, view.__selection_field__["primary"], pattern(rel), where,
+               projection("m", fields)),
+            {"primary_id": primary_id, "secondary_id": secondary_id})
+
+
+def related_document(view, name, rows, secondary_id=None):
+    if not rows:
+        return None
+
+    target = view.__model__["secondary"][name]
+    items = []
+    for document, rel_properties in rows[0]["related"]:
+        item = clean(document, target)
+        if rel_properties:
+            item["relationship"] = rel_properties
+        items.append(item)
+
+    if secondary_id is not None:
+        return {singularize(name): items[0] if items else None}
+    return {pluralize(name): items or None}
+
+
+def summary_document(node_document, related_documents):
+    """ GET /<resource>/<id>/summary: the node document with every secondary relation """
+    if node_document is None:
+        return None
+    result = dict(node_document)
+    for document in related_documents:
+        result.update(document or {})
+    return result
+
+
+def summary(view, primary_id):
+    """ the node and all its secondary relations, None when the node does not exist """
+    document = node_document(view, query(*node_query(view, primary_id)))
+    if document is None:
+        return None
+    return summary_document(document, [related_document(view, name, query(*related_query(view, primary_id, name)))
+                                       for name in view.__model__.get("secondary", {})])
+
+
+def related(view, primary_id, name, fields, secondary_id=None, snapshot=None):
+    """
+    projected GET /<resource>/<id>/<secondary>[/<secondary_id>], None when the node does not exist
+    read from snapshot (cmdb_snapshot) when given
+    """
+    if snapshot is not None:
+        model = view.__model__["primary"]
+        rel = relation(model, name, view.__model__["secondary"][name])
+        rows = snapshot.related(model, primary_id, rel, fields, secondary_id)
+    else:
+        rows = query(*related_query(view, primary_id, name, fields, secondary_id))
+    return related_document(view, name, rows, secondary_id)
@@ -0,0 +1,233 @@
+#coding=utf-8
+"""
+JSON query language over the labels and relationships of cmdb_model
+
+POST /v1/query filters one label on its own properties and on those of its
+neighbours, in one cypher query, e.g. the Apps that are down in environment X
+and depend on a CentOS6 host:
+
+    {"find": "app",
+     "where": {"run_status": "down"},
+     "related": [{"via": "environment", "where": {"environment_id": "X"}},
+                 {"via": "host", "where": {"OS": {"starts_with": "CentOS6"}}}],
+     "fields": ["app_name", "run_status"],
+     "limit": 50, "cursor": null}
+
+    find      lower case label (app, host, recommendedtype, ...)
+    where     {property: value} all true; a value is a scalar (equality), null
+              (missing) or {operator: operand}, operators: eq ne lt lte gt gte
+              in contains starts_with ends_with exists (true / false);
+              "and" / "or" take a list of where, "not" a where, nested up
+              to MAX_WHERE_DEPTH
+    related   a neighbour through a relationship of cmdb_model (App.host,
+              Host.app_depend, ...) matching its where and its own related,
+              "exists": false for none; nested up to MAX_DEPTH
+    fields    properties returned (cmdb_projection), the id is always returned
+    cursor    keyset paging on the id (cmdb_paging), next_cursor of the previous page
+
+properties and relationships are checked against cmdb_model and every value
+is a parameter, so a query is only ever filtering. queries of the same shape
+(same structure, other values) compile to the same cypher text: the compiled
+text is kept in an LRU (QUERY_PLAN_CACHE_SIZE) and neo4j reuses its plan.
+"""
+
+from functools import lru_cache
+
+from inflection import pluralize
+
+import cmdb_config
+import cmdb_paging
+from cmdb_graph import id_field, models, pattern, properties, query, relation
+from cmdb_projection import clean, parse_fields, projection
+
+OPERATORS = {"eq": "=", "ne": "<>", "lt": "<", "lte": "<=", "gt": ">", "gte": ">=", "in": "IN",
+             "contains": "CONTAINS", "starts_with": "STARTS WITH", "ends_with": "ENDS WITH"}
+
+MAX_DEPTH = 3
+MAX_WHERE_DEPTH = 8  # and / or / not
+MAX_VALUES = 50  # parameters of a query
+
+SCALARS = (str, int, float, bool)
+
+
+def _labels():
+    return {label.lower(): model for label, model in models().items()}
+
+
+def _operand(op, operand):
+    if op == "in":
+        if not isinstance(operand, list) or not all(isinstance(item, SCALARS) for item in operand):
+            raise ValueError("in expects a list of values")
+    elif not isinstance(operand, SCALARS):
+        raise ValueError("%s expects a value" % op)
+
+
+def _condition(condition, values):
+    """ shape of the condition on a property, its operands appended to values """
+    if condition is None:
+        return (("exists", False),)
+    if not isinstance(condition, dict):
+        condition = {"eq": condition}
+    if not condition:
+        raise ValueError("Empty condition")
+    shape = []
+    for op in sorted(condition):
+        operand = condition[op]
+        if op == "exists":
+            if not isinstance(operand, bool):
+                raise ValueError("exists expects true or false")
+            shape.append((op, operand))
+            continue
+        if op not in OPERATORS:
+            raise ValueError("Unknown operator: %s" % op)
+        _operand(op, operand)
+        values.append(operand)
+        shape.append((op, len(values) - 1))
+    return tuple(shape)
+
+
+def _where(where, values, depth=1):
+    if not isinstance(where, dict):
+        raise ValueError("where expects an object")
+    if depth > MAX_WHERE_DEPTH and any(key in ("and", "or", "not") for key in where):
+        raise ValueError("where is nested too deep")
+    shape = []
+    for key in sorted(where):
+        if key in ("and", "or"):
+            if not isinstance(where[key], list) or not where[key]:
+                raise ValueError("%s expects a list" % key)
+            shape.append((key, tuple(_where(item, values, depth + 1) for item in where[key])))
+        elif key == "not":
+            shape.append((key, _where(where[key], values, depth + 1)))
+        else:
+            shape.append(("property", key, _condition(where[key], values)))
+    return tuple(shape)
+
+
+def _related(related, values, depth):
+    if not isinstance(related, list):
+        raise ValueError("related expects a list")
+    if related and depth > MAX_DEPTH:
+        raise ValueError("related is nested too deep")
+    shape = []
+    for item in related:
+        if not isinstance(item, dict) or not isinstance(item.get("via"), str):
+            raise ValueError("related expects objects with a via")
+        unknown = set(item) - {"via", "where", "related", "exists"}
+        if unknown:
+            raise ValueError("Unknown keys: %s" % ", ".join(sorted(unknown)))
+        exists = item.get("exists", True)
+        if not isinstance(exists, bool):
+            raise ValueError("exists expects true or false")
+        shape.append((item["via"], exists, _where(item.get("where") or {}, values),
+                      _related(item.get("related") or [], values, depth + 1)))
+    return tuple(shape)
+
+
+def parse(document):
+    """
+    (shape, values) of a query document: the shape is the hashable structure of
+    the query with the values replaced by their index in values
+    """
+    if not isinstance(document, dict) or not isinstance(document.get("find"), str):
+        raise ValueError("Expecting a JSON object with find")
+    unknown = set(document) - {"find", "where", "related", "fields", "limit", "cursor"}
+    if unknown:
+        raise ValueError("Unknown keys: %s" % ", ".join(sorted(unknown)))
+    fields = document.get("fields")
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+        raise ValueError("fields expects a list of properties")
+    if not isinstance(document.get("cursor") or "", str):
+        raise ValueError("Invalid cursor")
+    limit = document.get("limit", cmdb_paging.DEFAULT_LIMIT)
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= cmdb_paging.MAX_LIMIT:
+        raise ValueError("limit expects a number from 1 to %d" % cmdb_paging.MAX_LIMIT)
+
+    values = []
+    shape = (document["find"].lower(), _where(document.get("where") or {}, values),
+             _related(document.get("related") or [], values, 1), tuple(fields) if fields is not None else None)
+    if len(values) > MAX_VALUES:
+        raise ValueError("Too many values, at most %d" % MAX_VALUES)
+    return shape, values
+
+
+def _target(model, name):
+    definition = model.defined_properties(aliases=False, properties=False).get(name)
+    if definition is None:
+        raise ValueError("%s has no relationship %s" % (model.__name__, name))
+    target = definition._raw_class
+    return relation(model, name, models()[target if isinstance(target, str) else target.__name__])
+
+
+def _compile_where(model, var, shape):
+    fields = properties(model)
+    terms = []
+    for item in shape:
+        if item[0] in ("and", "or"):
+            terms.append("(%s)" % (" %s " % item[0].upper()).join(
+                _compile_where(model, var, where) or "true" for where in item[1]))
+        elif item[0] == "not":
+            terms.append("NOT (%s)" % (_compile_where(model, var, item[1]) or "true"))
+        else:
+            _, name, condition = item
+            if name not in fields:
+                raise ValueError("Unknown property %s of %s" % (name, model.__name__))
+            for op, operand in condition:
+                if op == "exists":
+                    terms.append("%s.%s IS %sNULL" % (var, name, "NOT " if operand else ""))
+                else:
+                    terms.append("%s.%s %s $v%d" % (var, name, OPERATORS[op], operand))
+    return " AND ".join(terms)
+
+
+def _compile_related(model, var, shape):
+    terms = []
+    for index, (via, exists, where, related) in enumerate(shape):
+        rel = _target(model, via)
+        target = "%s_%d" % (var, index)
+        conditions = [term for term in (_compile_where(rel.model, target, where),
+                                        _compile_related(rel.model, target, related)) if term]
+        subquery = "EXISTS { MATCH %s%s }" % (pattern(rel, source=var, target=target, var=""),
+                                              " WHERE " + " AND ".join(conditions) if conditions else "")
+        terms.append(subquery if exists else "NOT " + subquery)
+    return " AND ".join(terms)
+
+
+@lru_cache(maxsize=cmdb_config.QUERY_PLAN_CACHE_SIZE)
+def compile_shape(shape):
+    """ cypher text of a query shape, with $after and $limit for the paging and $v<n> for the values """
+    find, where, related, fields = shape
+    model = _labels().get(find)
+    if model is None:
+        raise ValueError("Unknown label: %s" % find)
+    field = id_field(model)
+    fields = parse_fields(model, ",".join(fields)) if fields is not None else None
+
+    conditions = ["n.%s > $after" % field] + [term for term in (_compile_where(model, "n", where),
+                                                                _compile_related(model, "n", related)) if term]
+    return ("MATCH (n:%s) WHERE %s RETURN %s AS node ORDER BY n.%s LIMIT $limit"
+            % (model.__label__, " AND ".join(conditions), projection("n", fields), field))
+
+
+def run(document):
+    """ {<plural label>: nodes, "next_cursor": cursor of the next page or None}, raises ValueError on a bad query """
+    shape, values = parse(document)
+    limit = document.get("limit", cmdb_paging.DEFAULT_LIMIT)
+    cypher = compile_shape(shape)
+    model = _labels()[shape[0]]
+    field = id_field(model)
+
+    params = {"v%d" % index: value for index, value in enumerate(values)}
+    params["after"] = cmdb_paging.decode_cursor(field, document.get("cursor"))
+    params["limit"] = limit + 1
+    rows = query(cypher, params)
+
+    items = [clean(row["node"], model) for row in rows[:limit]]
+    next_cursor = cmdb_paging.encode_cursor(field, items[-1][field]) if len(rows) > limit else None
+    return {pluralize(model.__name__.lower()): items, "next_cursor": next_cursor}
+
+
+def stats():
+    """ counters of the compiled query LRU """
+    info = compile_shape.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "entries": info.currsize, "max_entries": info.maxsize}
@@ -0,0 +1,110 @@
+#coding=utf-8
+"""
+search across the CI types by partial name, ip or domain
+
+backed by one neo4j full-text (lucene) index over SEARCHED, created by
+python cmdb_schema.py create. the query is split in words like the
+lucene analyzer does, every word matches as a prefix and exact words rank higher:
+    "web-01 10.0"  ->  (web OR web*) AND (01 OR 01*) AND (10.0 OR 10.0*)
+
+without the full-text index (not created yet) the search falls back to a
+prefix (STARTS WITH) match on the btree indexed properties of SEARCHED.
+"""
+
+import re
+
+from neo4j.exceptions import ClientError
+
+from cmdb_graph import id_field, models, properties, query
+
+FULLTEXT_INDEX = "cmdb_search"
+
+# label -> searched properties
+SEARCHED = {
+    "App": ("app_name",),
+    "Host": ("host_name", "private_ip", "public_ip"),
+    "DB": ("db_name",),
+    "FileServer": ("fileserver_name", "fileserver_domain"),
+    "Person": ("person_name", "email"),
+    "Environment": ("environment_name",),
+    "DatabaseConnect": ("databaseconnect_name",),
+    "K8SNamespace": ("k8snamespace_name",),
+}
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+WORDS = re.compile(r"[\w.]+")
+
+
+def fulltext_properties():
+    """ every searched property, the full-text index covers each of them on each label """
+    names = []
+    for props in SEARCHED.values():
+        names.extend(name for name in props if name not in names)
+    return names
+
+
+def lucene(text):
+    """ lucene query of a search box input, None when there is nothing to search """
+    words = [word.lower() for word in WORDS.findall(text)]
+    if not words:
+        return None
+    return " AND ".join("(%s OR %s*)" % (word, word) for word in words)
+
+
+def _document(row, labels):
+    label = next(label for label in row["labels"] if label in labels)
+    model = labels[label]
+    fields = properties(model)
+    return {"type": label.lower(),
+            "id": row["properties"].get(id_field(model)),
+            "score": row["score"],
+            "properties": {key: value for key, value in row["properties"].items()
+                           if key in fields and value is not None}}
+
+
+def _fulltext(text, labels, limit):
+    return query("CALL db.index.fulltext.queryNodes($index, $query) YIELD node, score "
+                 "WHERE any(label IN labels(node) WHERE label IN $labels) "
+                 "RETURN labels(node) AS labels, properties(node) AS properties, score "
+                 "ORDER BY score DESC LIMIT $limit",
+                 {"index": FULLTEXT_INDEX, "query": lucene(text), "labels": list(labels), "limit": limit})
+
+
+def _prefix(text, labels, limit):
+    branches = []
+    for label in labels:
+        model = models()[label]
+        for name in SEARCHED[label]:
+            if properties(model)[name].index:
+                branches.append("MATCH (n:%s) WHERE n.%s STARTS WITH $text "
+                                "RETURN labels(n) AS labels, properties(n) AS properties, "
+                                "CASE n.%s WHEN $text THEN 2.0 ELSE 1.0 END AS score LIMIT $limit"
+                                % (label, name, name))
+    if not branches:
+        return []
+    rows = query(" UNION ".join(branches), {"text": text.strip(), "limit": limit})
+    return sorted(rows, key=lambda row: -row["score"])[:limit]
+
+
+def search(text, types=None, limit=DEFAULT_LIMIT):
+    """
+    ranked results [{"type": "host", "id": ..., "score": ..., "properties": {...}}]
+    types restricts the searched labels (lower case label names), raises ValueError on unknown ones
+    """
+    labels = {label: models()[label] for label in SEARCHED}
+    if types:
+        unknown = [name for name in types if name not in {label.lower() for label in labels}]
+        if unknown:
+            raise ValueError("Unknown types: %s" % ", ".join(unknown))
+        labels = {label: model for label, model in labels.items() if label.lower() in types}
+    if lucene(text) is None:
+        return []
+
+    try:
+        rows = _fulltext(text, labels, limit)
+    except ClientError:
+        # no full-text index yet
+        rows = _prefix(text, labels, limit)
+    return [_document(row, labels) for row in rows]
@@ -0,0 +1,347 @@
+#coding=utf-8
+"""
+in-memory read replica of the graph, one per API process (SNAPSHOT in cmdb_config)
+
+the CMDB is small enough (a few hundred thousand nodes) to keep every node
+and edge in adjacency lists; the dependency / impact traversals and the
+GET /<resource>/<id>/<secondary> neighbour reads are then served from memory
+instead of neo4j, in the same format.
+
+the snapshot is loaded in a background thread of each worker (on its first
+request, after the fork). every SNAPSHOT_REFRESH seconds, or sooner after a
+write through this process, the changes appended to the change log
+(cmdb_changes) since the snapshot was taken are applied to it: only the nodes
+they name are read again, with their relationships. the whole graph is only
+loaded again every SNAPSHOT_RELOAD seconds, or when the change log cannot say
+what changed (pruned, a delete of every node, too many changes at once).
+without a change log (CHANGES off) it is loaded every RELOAD_WITHOUT_CHANGES
+seconds, or sooner after a write through this process. the
+updated snapshot is a copy that replaces the old one at once, readers never
+see it half applied. responses served from it carry X-Snapshot-Loaded-At (the
+last time it caught up), and a snapshot older than SNAPSHOT_MAX_STALENESS is
+not used (neo4j is queried instead).
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from email.utils import formatdate
+
+from neomodel.relationship_manager import OUTGOING
+
+import cmdb_changes
+import cmdb_config
+import cmdb_driver
+from cmdb_graph import id_field, models
+
+# shortest delay between two rebuilds, however many writes
+MIN_INTERVAL = 5
+
+# more changed nodes than that at once are read with a full load
+MAX_DELTA = 10000
+
+# seconds between two full loads when there is no change log to catch up on
+RELOAD_WITHOUT_CHANGES = 60
+
+
+class Reload(Exception):
+    """ the changes cannot be applied, the whole graph has to be loaded again """
+
+
+class Snapshot(object):
+    """ nodes and edges of the graph, keyed on the neo4j internal ids """
+
+    def __init__(self):
+        self.loaded_at = None
+        self.seq = 0          # last change of the change log it contains
+        self.labels = {}      # node -> label
+        self.properties = {}  # node -> properties
+        self.keys = {}        # (label, *_id) -> node
+        self.outgoing = {}    # node -> [(type, target, properties)]
+        self.incoming = {}    # node -> [(type, source, properties)]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add_node(self, node, labels, properties, id_fields):
+        label = next((label for label in labels if label in id_fields), None)
+        if label is None:
+            return
+        self.labels[node] = label
+        self.properties[node] = properties
+        if properties.get(id_fields[label]) is not None:
+            self.keys[(label, properties[id_fields[label]])] = node
+
+    def add_edge(self, source, rel_type, target, properties):
+        if source in self.labels and target in self.labels:
+            self.outgoing.setdefault(source, []).append((rel_type, target, properties))
+            self.incoming.setdefault(target, []).append((rel_type, source, properties))
+
+    def copy(self):
+        """ a copy sharing the node properties and adjacency lists, which are replaced and never changed """
+        other = Snapshot()
+        other.loaded_at, other.seq = self.loaded_at, self.seq
+        for name in ("labels", "properties", "keys", "outgoing", "incoming"):
+            setattr(other, name, dict(getattr(self, name)))
+        return other
+
+    def _unlink(self, node):
+        """ drop the relationships of node from the lists of its neighbours """
+        for _, other, _ in self.outgoing.get(node, ()):
+            if other != node:
+                self.incoming[other] = [edge for edge in self.incoming.get(other, ()) if edge[1] != node]
+        for _, other, _ in self.incoming.get(node, ()):
+            if other != node:
+                self.outgoing[other] = [edge for edge in self.outgoing.get(other, ()) if edge[1] != node]
+
+    def remove_node(self, node):
+        self._unlink(node)
+        self.outgoing.pop(node, None)
+        self.incoming.pop(node, None)
+        self.labels.pop(node, None)
+        self.properties.pop(node, None)
+
+    def set_edges(self, node, outgoing, incoming):
+        """ replace the relationships of node, (type, other node, properties) in each direction """
+        self._unlink(node)
+        self.outgoing[node] = [edge for edge in outgoing if edge[1] in self.labels]
+        self.incoming[node] = [edge for edge in incoming if edge[1] in self.labels]
+        for rel_type, other, properties in self.outgoing[node]:
+            if other != node:
+                self.incoming[other] = self.incoming.get(other, []) + [(rel_type, node, properties)]
+        for rel_type, other, properties in self.incoming[node]:
+            if other != node:
+                self.outgoing[other] = self.outgoing.get(other, []) + [(rel_type, node, properties)]
+
+    def age(self):
+        return time.time() - self.loaded_at
+
+    def find(self, model, node_id):
+        return self.keys.get((model.__label__, node_id))
+
+    def reach(self, start, types, depth, reverse=False):
+        """ nodes at most depth hops away from start over types edges (breadth first), start excluded """
+        adjacency = self.incoming if reverse else self.outgoing
+        seen, queue = {start: 0}, deque([start])
+        while queue:
+            node = queue.popleft()
+            if seen[node] == depth:
+                continue
+            for rel_type, other, _ in adjacency.get(node, ()):
+                if rel_type in types and other not in seen:
+                    seen[other] = seen[node] + 1
+                    queue.append(other)
+        del seen[start]
+        return list(seen)
+
+    def closure(self, model, node_id, types, depth, reverse=False):
+        """ the rows of cmdb_traversal._closure, [] when the node does not exist """
+        start = self.find(model, node_id)
+        if start is None:
+            return []
+        nodes = [start] + self.reach(start, types, depth, reverse)
+        members = set(nodes)
+        return [{"node": node,
+                 "labels": [self.labels[node]],
+                 "properties": self.properties[node],
+                 "edges": [{"type": rel_type, "target": target, "properties": properties}
+                           for rel_type, target, properties in self.outgoing.get(node, ())
+                           if rel_type in types and target in members]}
+                for node in nodes]
+
+    def counts(self, model, node_id, types, depth, reverse=False):
+        """ reached nodes per label, None when the node does not exist """
+        start = self.find(model, node_id)
+        if start is None:
+            return None
+        counts = {}
+        for node in self.reach(start, types, depth, reverse):
+            counts[self.labels[node]] = counts.get(self.labels[node], 0) + 1
+        return counts
+
+    def related(self, model, node_id, rel, fields=None, secondary_id=None):
+        """ the rows of cmdb_projection.related_query, [] when the node does not exist """
+        start = self.find(model, node_id)
+        if start is None:
+            return []
+        adjacency = self.outgoing if rel.direction == OUTGOING else self.incoming
+        target_field = id_field(rel.model)
+        related = []
+        for rel_type, other, rel_properties in adjacency.get(start, ()):
+            if rel_type != rel.type or self.labels[other] != rel.model.__label__:
+                continue
+            properties = self.properties[other]
+            if secondary_id is not None and properties.get(target_field) != secondary_id:
+                continue
+            if fields is not None:
+                properties = {name: properties.get(name) for name in fields}
+            related.append([properties, rel_properties])
+        return [{"node": start, "related": related}]
+
+
+def load(driver):
+    """ a snapshot of the whole graph, read with two streamed queries """
+    id_fields = {label: id_field(model) for label, model in models().items()}
+    snapshot = Snapshot()
+    # changes after this seq may or may not be in the snapshot, catch_up applies them again
+    snapshot.seq = cmdb_changes.head()[0] if cmdb_config.CHANGES else 0
+    with driver.session() as session:
+        for record in session.run("MATCH (n) RETURN id(n), labels(n), properties(n)"):
+            snapshot.add_node(record[0], record[1], record[2], id_fields)
+        for record in session.run("MATCH (a)-[r]->(b) RETURN id(a), type(r), id(b), properties(r)"):
+            snapshot.add_edge(record[0], record[1], record[2], record[3])
+    snapshot.loaded_at = time.time()
+    return snapshot
+
+
+def _changed_keys(snapshot):
+    """ ((label, id) of the nodes changed after snapshot.seq, seq of the last change) """
+    resources = {model.__name__.lower(): model for model in models().values()}
+    keys, since = set(), snapshot.seq
+    while True:
+        result = cmdb_changes.read(since, cmdb_changes.MAX_LIMIT)
+        for change in result["changes"]:
+            model = resources.get(change["resource"])
+            if model is None or change["id"] is None:
+                raise Reload("change %d cannot be applied" % change["seq"])
+            keys.add((model.__label__, change["id"]))
+        if len(keys) > MAX_DELTA:
+            raise Reload("%d nodes changed" % len(keys))
+        if result["next_since"] == since:
+            return keys, since
+        since = result["next_since"]
+
+
+def catch_up(snapshot, driver):
+    """
+    a copy of snapshot with the changes appended to the change log since it
+    was taken, raises Reload (or cmdb_changes.Pruned) when a full load is needed
+    """
+    if not cmdb_config.CHANGES:
+        raise Reload("no change log")
+    keys, seq = _changed_keys(snapshot)
+    updated = snapshot.copy() if keys else snapshot
+    if keys:
+        id_fields = {label: id_field(model) for label, model in models().items()}
+        ids = {}
+        for label, node_id in keys:
+            ids.setdefault(label, []).append(node_id)
+        rows = []
+        with driver.session() as session:
+            for label, label_ids in ids.items():
+                rows.extend(session.run(
+                    "MATCH (n:%s) WHERE n.%s IN $ids "
+                    "RETURN id(n) AS node, labels(n) AS labels, properties(n) AS properties, "
+                    "[(n)-[r]->(m) | [type(r), id(m), properties(r)]] AS outgoing, "
+                    "[(n)<-[r]-(m) | [type(r), id(m), properties(r)]] AS incoming"
+                    % (label, id_fields[label]), {"ids": label_ids}).data())
+
+        # deleted nodes are not found any more
+        found = {(label, row["properties"].get(id_fields[label])) for row in rows
+                 for label in row["labels"] if label in id_fields}
+        for key in keys - found:
+            node = updated.keys.pop(key, None)
+            if node is not None:
+                updated.remove_node(node)
+        for row in rows:
+            updated.add_node(row["node"], row["labels"], row["properties"], id_fields)
+        for row in rows:
+            if row["node"] in updated.labels:
+                updated.set_edges(row["node"], [tuple(edge) for edge in row["outgoing"]],
+                                  [tuple(edge) for edge in row["incoming"]])
+    updated.seq = seq
+    updated.loaded_at = time.time()
+    return updated
+
+
+class Refresher(threading.Thread):
+    """ rebuilds the snapshot of the current process in the background """
+
+    def __init__(self, refresh):
+        super(Refresher, self).__init__(name="cmdb-snapshot", daemon=True)
+        self.refresh = refresh
+        self.snapshot = None
+        self.wakeup = threading.Event()
+
+    def _catch_up(self):
+        try:
+            self.snapshot = catch_up(self.snapshot, cmdb_driver.shared_driver())
+            return True
+        except (Reload, cmdb_changes.Pruned) as e:
+            logging.info("graph snapshot reloaded, %s: %s", type(e).__name__, e)
+            return False
+
+    def _reload(self, started, reloaded):
+        """ whether the whole graph has to be loaded, catches up on the change log otherwise """
+        if self.snapshot is None or started - reloaded >= cmdb_config.SNAPSHOT_RELOAD:
+            return True
+        # 没有 change log 时只能整体加载, 由 wait 的间隔控制频率
+        return not cmdb_config.CHANGES or not self._catch_up()
+
+    def run(self):
+        reloaded = 0
+        while True:
+            started = time.time()
+            try:
+                cmdb_driver.use_shared_driver()
+                if self._reload(started, reloaded):
+                    self.snapshot = load(cmdb_driver.shared_driver())
+                    reloaded = started
+                    logging.info("graph snapshot loaded, %d nodes in %.1fs",
+                                 len(self.snapshot), time.time() - started)
+            except Exception:
+                logging.exception("could not load the graph snapshot")
+            time.sleep(max(0, MIN_INTERVAL - (time.time() - started)))
+            self.wakeup.wait(self.refresh if cmdb_config.CHANGES else max(self.refresh, RELOAD_WITHOUT_CHANGES))
+            self.wakeup.clear()
+
+
+_refresher = None
+_refresher_pid = None
+_lock = threading.Lock()
+
+# snapshot set with install(), used as is
+_installed = None
+
+
+def _current_refresher():
+    global _refresher, _refresher_pid
+    with _lock:
+        if _refresher is None or _refresher_pid != os.getpid():
+            # threads do not survive a fork, each worker starts its own
+            _refresher = Refresher(cmdb_config.SNAPSHOT_REFRESH)
+            _refresher_pid = os.getpid()
+            _refresher.start()
+        return _refresher
+
+
+def install(snapshot):
+    """ serve reads from snapshot in this process instead of loading one (benchmarks) """
+    global _installed
+    _installed = snapshot
+
+
+def fresh():
+    """ the snapshot of this process, None when disabled, not loaded yet or too stale """
+    if _installed is not None:
+        return _installed
+    if not cmdb_config.SNAPSHOT:
+        return None
+    snapshot = _current_refresher().snapshot
+    if snapshot is None or snapshot.age() > cmdb_config.SNAPSHOT_MAX_STALENESS:
+        return None
+    return snapshot
+
+
+def changed():
+    """ a write went through this process, rebuild soon """
+    if cmdb_config.SNAPSHOT and _refresher is not None and _refresher_pid == os.getpid():
+        _refresher.wakeup.set()
+
+
+def headers(snapshot):
+    """ staleness headers of a response served from snapshot """
+    return {"X-Snapshot-Loaded-At": formatdate(snapshot.loaded_at, usegmt=True),
+            "X-Snapshot-Max-Staleness": str(cmdb_config.SNAPSHOT_MAX_STALENESS)}
@@ -0,0 +1,109 @@
+#coding=utf-8
+"""
+per environment aggregates for the capacity reports
+
+    {"environment_id": ..., "environment_name": ...,
+     "counts": {"app": 12, "host": 30, ...},
+     "app_by_run_status": {"running": 10, "stopped": 2},
+     "host_by_OS": {"CentOS 7": 25, "unknown": 5}}
+
+one cypher aggregation per request (for one or for every environment). the
+responses go through cmdb_cache like the other GET routes (TTL, ETag) and are
+also tagged with the counted labels, so a write on an App or a Host drops them.
+"""
+
+from inflection import pluralize
+from neomodel.relationship_manager import OUTGOING
+
+from cmdb_graph import secondary_relations, query
+
+# secondary names of EnvironmentView that are counted
+COUNTED = ("app", "host", "db", "md", "k8snamespace", "fileserver")
+
+# secondary name -> property broken down
+BREAKDOWNS = {
+    "app": "run_status",
+    "host": "OS",
+}
+
+UNKNOWN = "unknown"
+
+
+def _relations(view):
+    relations = secondary_relations(view)
+    return [relations[name] for name in COUNTED]
+
+
+def counted_models(view):
+    return [rel.model for rel in _relations(view)]
+
+
+def _aggregate(view, environment_id=None):
+    model = view.__model__["primary"]
+    field = view.__selection_field__["primary"]
+    relations = _relations(view)
+
+    matches, names, values = [], [], []
+    for rel in relations:
+        end = "endNode(r)" if rel.direction == OUTGOING else "startNode(r)"
+        matches.append("(type(r) = '%s' AND %s = m AND m:%s)" % (rel.type, end, rel.model.__label__))
+        names.append("WHEN m:%s THEN '%s'" % (rel.model.__label__, rel.name))
+        if rel.name in BREAKDOWNS:
+            values.append("WHEN m:%s THEN m.%s" % (rel.model.__label__, BREAKDOWNS[rel.name]))
+
+    where = "WHERE e.%s = $environment_id " % field if environment_id is not None else ""
+    return query("MATCH (e:%s) %s"
+                 "OPTIONAL MATCH (e)-[r]-(m) WHERE %s "
+                 "WITH e, CASE %s END AS name, CASE %s ELSE NULL END AS value, count(DISTINCT m) AS count "
+                 "RETURN e.%s AS id, properties(e) AS properties, "
+                 "collect({name: name, value: value, count: count}) AS counts "
+                 "ORDER BY id"
+                 % (model.__label__, where, " OR ".join(matches), " ".join(names),
+                    " ".join(values), field),
+                 {"environment_id": environment_id})
+
+
+def _empty():
+    document = {"counts": {name: 0 for name in COUNTED}}
+    for name, field in BREAKDOWNS.items():
+        document["%s_by_%s" % (name, field)] = {}
+    return document
+
+
+def _add(document, name, value, count):
+    document["counts"][name] += count
+    if name in BREAKDOWNS:
+        breakdown = document["%s_by_%s" % (name, BREAKDOWNS[name])]
+        value = UNKNOWN if value is None else str(value)
+        breakdown[value] = breakdown.get(value, 0) + count
+
+
+def _document(row):
+    document = dict(row["properties"])
+    document.update(_empty())
+    for count in row["counts"]:
+        if count["name"] is not None:
+            _add(document, count["name"], count["value"], count["count"])
+    return document
+
+
+def environment_stats(view, environment_id):
+    """ aggregates of one environment, None when it does not exist """
+    rows = _aggregate(view, environment_id)
+    if not rows:
+        return None
+    return _document(rows[0])
+
+
+def all_stats(view):
+    """ aggregates of every environment, plus their totals """
+    environments = [_document(row) for row in _aggregate(view)]
+    totals = _empty()
+    for document in environments:
+        for name, count in document["counts"].items():
+            totals["counts"][name] += count
+        for name, field in BREAKDOWNS.items():
+            key = "%s_by_%s" % (name, field)
+            for value, count in document[key].items():
+                totals[key][value] = totals[key].get(value, 0) + count
+    return {pluralize(view.__model__["primary"].__name__.lower()): environments, "totals": totals}
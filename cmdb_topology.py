@@ -0,0 +1,225 @@
+#coding=utf-8
+"""
+compact topology of an environment, for the graph view of the UI
+
+GET /v1/topology?environment=<id> returns the whole environment in one
+response instead of a call per node: the environment, every node linked to
+it, and the nodes they use that belong to no environment (RecommendedType,
+Person, ...), with the relationships between them. nodes of another
+environment and the edges to them are left out.
+
+the format is array backed, no key is repeated per node or edge:
+    {"environment": "<id>", "root": 0, "seq": 42, "built_at": <ms>,
+     "labels": ["App", "Environment", ...],
+     "tables": {"App": {"offset": 1, "count": 2, "columns": ["app_id", "app_name", ...],
+                        "values": [["a1", "a2"], ["web", "db"], ...]}, ...},
+     "types": ["Belong_TO", "Depend_ON", ...],
+     "edges": {"count": 3, "source": [1, 2, 1], "target": [0, 0, 2], "type": [0, 0, 1]}}
+a node is referred to by its index: the offset of its table plus its row,
+root is the index of the environment. edge i goes from source[i] to
+target[i] and its type is types[type[i]].
+
+with Accept: application/msgpack (or ?format=msgpack) the same document is
+MessagePack encoded (msgpack has to be installed) and source, target and type
+are binary little-endian uint32 arrays (Uint32Array in the browser).
+
+the topology is built once and the encoded bodies are kept per environment
+(TOPOLOGY_CACHE_SIZE environments per process); it is rebuilt after
+TOPOLOGY_TTL seconds, or when a change appended to the log (cmdb_changes)
+since touches one of its nodes. changes to other environments only move its
+seq on, the cached bodies (and their ETag) are kept.
+"""
+
+import hashlib
+import json
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+import cmdb_changes
+import cmdb_config
+from cmdb_graph import id_field, models, properties, stream
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMATS = ("json", "msgpack")
+MIMETYPES = {"json": "application/json", "msgpack": "application/msgpack"}
+
+
+class Topology(object):
+    """ the encoded bodies of the topology of an environment """
+
+    def __init__(self, environment_id, seq, document):
+        self.environment_id = environment_id
+        self.seq = seq
+        self.built_at = time.time()
+        self.nodes = sum(table["count"] for table in document["tables"].values())
+        self.edges = document["edges"]["count"]
+        # 第一列是 id 字段
+        self.ids = {node_id for table in document["tables"].values() for node_id in table["values"][0]}
+        self.bodies = {}  # (format, gzip) -> bytes
+        self.bodies[("json", False)] = json.dumps(document, separators=(",", ":"), default=str).encode("utf-8")
+        if msgpack is not None:
+            edges = document["edges"]
+            binary = dict(document, edges=dict(edges, **{name: _uint32(edges[name])
+                                                         for name in ("source", "target", "type")}))
+            self.bodies[("msgpack", False)] = msgpack.packb(binary, use_bin_type=True, default=str)
+        for fmt in FORMATS:
+            if (fmt, False) in self.bodies:
+                self.bodies[(fmt, True)] = _gzip(self.bodies[(fmt, False)])
+        self.etag = hashlib.sha1(self.bodies[("json", False)]).hexdigest()
+
+    def age(self):
+        return time.time() - self.built_at
+
+    def body(self, fmt, gzip=False):
+        return self.bodies.get((fmt, gzip))
+
+
+def _uint32(values):
+    data = array("I", values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(wbits=31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _members(environment_id):
+    """ (neo4j id, label, properties) of the nodes of the environment, the environment first """
+    return stream("MATCH (e:Environment {environment_id: $id}) "
+                  "CALL { WITH e MATCH (e)--(m) RETURN collect(DISTINCT m) AS members } "
+                  "CALL { WITH members UNWIND members AS x MATCH (x)--(s) "
+                  "       WHERE NOT s:Environment AND NOT (s)-[:Belong_TO]->(:Environment) "
+                  "       RETURN collect(DISTINCT s) AS shared } "
+                  "UNWIND [e] + members + shared AS n "
+                  "WITH DISTINCT n "
+                  "RETURN id(n) AS node, labels(n) AS labels, properties(n) AS properties",
+                  {"id": environment_id})
+
+
+def build(environment_id):
+    """ the compact document of the topology of an environment, None when it does not exist """
+    by_label = models()
+    rows = {}  # label -> [(neo4j id, properties)]
+    root = None
+    for row in _members(environment_id):
+        label = next((label for label in row["labels"] if label in by_label), None)
+        if label is None:
+            continue
+        if root is None:
+            root = row["node"]
+        rows.setdefault(label, []).append((row["node"], row["properties"]))
+    if root is None:
+        return None
+
+    index, tables, offset = {}, OrderedDict(), 0
+    for label in sorted(rows):
+        model = by_label[label]
+        field = id_field(model)
+        columns = [field] + sorted(name for name in properties(model) if name != field)
+        tables[label] = {"offset": offset, "count": len(rows[label]), "columns": columns,
+                         "values": [[props.get(column) for _, props in rows[label]] for column in columns]}
+        for node, _ in rows[label]:
+            index[node] = offset
+            offset += 1
+
+    types, sources, targets, type_ids = {}, [], [], []
+    for row in stream("MATCH (a)-[r]->(b) WHERE id(a) IN $nodes "
+                      "RETURN id(a) AS source, type(r) AS type, id(b) AS target",
+                      {"nodes": list(index)}):
+        if row["target"] not in index:
+            continue
+        sources.append(index[row["source"]])
+        targets.append(index[row["target"]])
+        type_ids.append(types.setdefault(row["type"], len(types)))
+
+    return {"environment": environment_id, "root": index[root], "built_at": int(time.time() * 1000),
+            "labels": list(tables), "tables": tables, "types": list(types),
+            "edges": {"count": len(sources), "source": sources, "target": targets, "type": type_ids}}
+
+
+_cache = OrderedDict()  # environment id -> Topology, least recently used first
+_lock = threading.Lock()
+_building = {}  # environment id -> lock, one build at a time per environment
+
+
+def _fresh(topology, seq):
+    return topology is not None and topology.seq == seq and topology.age() < cmdb_config.TOPOLOGY_TTL
+
+
+def _touched(topology, seq):
+    """ whether a change after topology.seq up to seq is about one of its nodes """
+    since = topology.seq
+    try:
+        while since < seq:
+            result = cmdb_changes.read(since, cmdb_changes.MAX_LIMIT)
+            for change in result["changes"]:
+                if change["id"] is None or change["id"] in topology.ids or change["target_id"] in topology.ids:
+                    return True
+            if result["next_since"] == since:
+                break
+            since = result["next_since"]
+    except cmdb_changes.Pruned:
+        return True
+    return False
+
+
+def _current(topology, seq):
+    """ whether topology can be served at seq, its seq is moved on when the changes since are elsewhere """
+    if _fresh(topology, seq):
+        return True
+    if topology is None or seq is None or topology.seq is None or topology.seq > seq \
+            or topology.age() >= cmdb_config.TOPOLOGY_TTL or _touched(topology, seq):
+        return False
+    with _lock:
+        topology.seq = max(topology.seq, seq)
+    return True
+
+
+def get(environment_id):
+    """ the cached Topology of an environment, rebuilt when stale, None when it does not exist """
+    seq = cmdb_changes.head()[0] if cmdb_config.CHANGES else None
+    with _lock:
+        topology = _cache.get(environment_id)
+    if _current(topology, seq):
+        with _lock:
+            if environment_id in _cache:
+                _cache.move_to_end(environment_id)
+        return topology
+
+    with _lock:
+        building = _building.setdefault(environment_id, threading.Lock())
+    with building:
+        # 等锁期间其他线程可能已经重建
+        with _lock:
+            topology = _cache.get(environment_id)
+        if _current(topology, seq):
+            return topology
+
+        document = build(environment_id)
+        topology = Topology(environment_id, seq, dict(document, seq=seq)) if document is not None else None
+        with _lock:
+            _building.pop(environment_id, None)
+            if topology is None:
+                _cache.pop(environment_id, None)
+                return None
+            _cache[environment_id] = topology
+            _cache.move_to_end(environment_id)
+            while len(_cache) > cmdb_config.TOPOLOGY_CACHE_SIZE:
+                _cache.popitem(last=False)
+        return topology
+
+
+def clear():
+    with _lock:
+        _cache.clear()
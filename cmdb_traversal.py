@@ -0,0 +1,113 @@
+#coding=utf-8
+"""
+multi-hop traversals over the CMDB graph
+
+each traversal is a single variable-length cypher query that returns the
+reached nodes together with the edges between them, as a deduplicated
+nodes/edges document:
+    {"nodes": [{"id": ..., "label": ..., "properties": {...}}],
+     "edges": [{"source": ..., "target": ..., "type": ..., "properties": {...}}]}
+"""
+
+from cmdb_graph import id_field, models, query
+
+# (App)-[USE]->(DatabaseConnect)-[Belong_TO]->(DB)-[Depend_ON]->(Host) ...
+# Manage_TO only links persons and is not a dependency
+DEPENDENCY_TYPES = ("Belong_TO", "Depend_ON", "USE")
+
+DEFAULT_DEPTH = 4
+MAX_DEPTH = 10
+
+
+def _subgraph(rows):
+    """ build the nodes/edges document from (node, labels, properties, edges) rows """
+    labels = models()
+    keys, nodes, edges = {}, [], []
+    for row in rows:
+        label = row["labels"][0] if row["labels"] else None
+        model = labels.get(label)
+        node_id = row["properties"].get(id_field(model)) if model is not None else None
+        keys[row["node"]] = node_id if node_id is not None else str(row["node"])
+        nodes.append({"id": keys[row["node"]], "label": label, "properties": row["properties"]})
+
+    for row in rows:
+        for edge in row["edges"]:
+            edges.append({"source": keys[row["node"]], "target": keys[edge["target"]],
+                          "type": edge["type"], "properties": edge["properties"]})
+
+    return {"nodes": nodes, "edges": edges}
+
+
+def _closure(model, node_id, depth, reverse=False, snapshot=None):
+    """
+    nodes reached from (or, when reverse, reaching) a node over the dependency edges
+    read from snapshot (cmdb_snapshot) when given
+    """
+    if snapshot is not None:
+        return snapshot.closure(model, node_id, DEPENDENCY_TYPES, depth, reverse)
+
+    types = "|".join(DEPENDENCY_TYPES)
+    path = ("<-[:%s*1..%d]-" if reverse else "-[:%s*1..%d]->") % (types, depth)
+    rows = query("MATCH (s:%s {%s: $node_id}) "
+                 "OPTIONAL MATCH (s)%s(m) "
+                 "WITH s, collect(DISTINCT m) AS reached "
+                 "UNWIND [s] + reached AS n "
+                 "OPTIONAL MATCH (n)-[r:%s]->(m) "
+                 "RETURN id(n) AS node, labels(n) AS labels, properties(n) AS properties, "
+                 "collect(CASE WHEN r IS NULL THEN NULL "
+                 "ELSE {type: type(r), target: id(m), properties: properties(r)} END) AS edges"
+                 % (model.__label__, id_field(model), path, types),
+                 {"node_id": node_id})
+
+    # 边的终点在 python 里用 set 判断是否属于闭包, 避免 cypher 里 m IN nodes 的线性扫描
+    members = {row["node"] for row in rows}
+    for row in rows:
+        row["edges"] = [edge for edge in row["edges"] if edge["target"] in members]
+    return rows
+
+
+def dependencies(app_id, depth=DEFAULT_DEPTH, snapshot=None):
+    """
+    everything an App depends on, up to depth hops away
+    (App -> DatabaseConnect -> DB -> Host, App -> K8SNamespace -> K8S, ...)
+
+    returns None when the App does not exist
+    """
+    rows = _closure(models()["App"], app_id, depth, snapshot=snapshot)
+    if not rows:
+        return None
+    return _subgraph(rows)
+
+
+def impact(model, node_id, depth=DEFAULT_DEPTH, count_only=False, snapshot=None):
+    """
+    blast radius of a node: everything depending on it, up to depth hops away
+    (Host <- DB <- DatabaseConnect <- App, Host <- MD, Host <- App, ...)
+
+    count_only returns the number of impacted nodes per label instead of the
+    subgraph. returns None when the node does not exist
+    """
+    if count_only and snapshot is not None:
+        counts = snapshot.counts(model, node_id, DEPENDENCY_TYPES, depth, reverse=True)
+        return {"counts": counts} if counts is not None else None
+
+    if count_only:
+        rows = query("MATCH (s:%s {%s: $node_id}) "
+                     "OPTIONAL MATCH (s)<-[:%s*1..%d]-(m) "
+                     "RETURN labels(m)[0] AS label, count(DISTINCT m) AS count"
+                     % (model.__label__, id_field(model), "|".join(DEPENDENCY_TYPES), depth),
+                     {"node_id": node_id})
+        if not rows:
+            return None
+        return {"counts": {row["label"]: row["count"] for row in rows if row["label"] is not None}}
+
+    rows = _closure(model, node_id, depth, reverse=True, snapshot=snapshot)
+    if not rows:
+        return None
+    graph = _subgraph(rows)
+    counts = {}
+    for node in graph["nodes"]:
+        if node["id"] != node_id:
+            counts[node["label"]] = counts.get(node["label"], 0) + 1
+    graph["counts"] = counts
+    return graph
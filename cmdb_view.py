@@ -2,28 +2,414 @@
 
 import global_config
 from cmdb_model import *
+import cmdb_bulk
+import cmdb_cache
+import cmdb_changes
+import cmdb_config
+import cmdb_consistency
+import cmdb_driver
+import cmdb_etag
+import cmdb_export
+import cmdb_graph
+import cmdb_history
+import cmdb_lookup
+import cmdb_metrics
+import cmdb_paging
+import cmdb_profile
+import cmdb_projection
+import cmdb_query
+import cmdb_schema
+import cmdb_search
+import cmdb_snapshot
+import cmdb_stats
+import cmdb_topology
+import cmdb_traversal
 import markupsafe
 import neomodel
 import logging
-from flask import Flask, jsonify
-from flask_classful import route
+import time
+from flask import Flask, Response, g, jsonify, make_response, request, stream_with_context
+from flask_classful import FlaskView, route
 from grest import GRest
+from grest.auth import authenticate, authorize
+from grest.global_config import QUERY_LIMIT
+from grest.verbs.delete import delete as delete_verb, delete_all as delete_all_verb
+from grest.verbs.patch import patch as patch_verb
+from grest.verbs.post import post as post_verb
+from grest.verbs.put import put as put_verb
+from inflection import pluralize
 from flask_cors import CORS
 
 # from flask_restplus import Resource, Api
 from flask_restful_swagger_2 import Api, swagger, Resource
 
-# 通过下面的方式进行简单配置输出方式与日志级别
-logging.basicConfig(filename='logger.log', level=logging.INFO)
+# 日志为 JSON 格式, 每行带 request_id (LOG_FILE, LOG_LEVEL 见 cmdb_config)
+cmdb_metrics.configure_logging()
 
-logging.debug('debug message')
-logging.info('info message')
-logging.warn('warn message')
-logging.error('error message')
-logging.critical('critical message')
 
+def int_arg(name, default, low, high):
+    """ integer query string argument, raises ValueError when out of [low, high] """
+    value = int(request.args.get(name, default))
+    if not low <= value <= high:
+        raise ValueError("%s must be between %d and %d" % (name, low, high))
+    return value
 
-class AppView(GRest):
+
+def bool_arg(name):
+    """ boolean query string flag (?name=1, ?name=true) """
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
+
+
+# grest.auth hooks (app.authentication_function / authorization_function) of a view,
+# None when the request is allowed, otherwise the error response of grest
+check_auth = authenticate(authorize(lambda view: None))
+
+
+def impact_response(model, node_id):
+    """ shared by the /<id>/impact routes of HostView and DBView """
+    try:
+        depth = int_arg("depth", cmdb_traversal.DEFAULT_DEPTH, 1, cmdb_traversal.MAX_DEPTH)
+    except ValueError:
+        return jsonify(errors=["Validation failed!"]), 422
+
+    g.snapshot = cmdb_snapshot.fresh()
+    try:
+        graph = cmdb_traversal.impact(model, str(markupsafe.escape(node_id)), depth, bool_arg("count"),
+                                      g.snapshot)
+        if graph is None:
+            return jsonify(errors=["Selected %s does not exists!" % model.__name__]), 404
+        return jsonify(depth=depth, **graph), 200
+    except:
+        logging.exception("impact of %s %s failed", model.__name__, node_id)
+        return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class CMDBView(GRest):
+    """
+    base view of the CMDB resources
+    GET /<resource>?cursor=[&limit=] pages on the primary selection field
+    (keyset paging), the response carries the next_cursor to pass on;
+    without cursor the GRest skip/limit paging is used
+    GET /<resource>/export[?relations=1&gzip=1] streams every node as NDJSON
+    GET /<resource>/<id>/summary the node and all its secondary relations (as cmdb_async)
+    GET routes accept ?fields=a,b (and fields[<secondary>]=) to return only
+    those properties, and the primary ones ?include=host,databaseconnect.db
+    to embed neighbours in the same query, see cmdb_projection
+
+    GET responses go through cmdb_cache, writes invalidate what they touch
+    GET responses carry an ETag and honour If-None-Match (see cmdb_etag)
+
+    with SNAPSHOT on, neighbour reads come from cmdb_snapshot (X-Snapshot-* headers)
+
+    writes are appended to the change log, see cmdb_changes and /changes
+    GET /<resource>/<id>[/<secondary>[/<secondary_id>]]?as_of=<ts> reads the
+    versions of cmdb_history instead of the current graph
+
+    GET /<resource>/by-<key>/<value> finds nodes by a natural key of
+    __natural_keys__, POST /<resource>/by-<key> resolves a batch of values
+    """
+
+    # natural key -> indexed properties it matches, see cmdb_lookup
+    __natural_keys__ = {}
+
+    # POST routes that do not write
+    __read_only__ = ("lookup_batch",)
+
+    def before_request(self, name, **kwargs):
+        response = cmdb_cache.lookup(request)
+        if response is not None:
+            # a cached response is served without the handler, check the caller first
+            return check_auth(self) or response.make_conditional(request)
+
+        snapshot_read = kwargs.get("secondary_model_name") and cmdb_snapshot.fresh() is not None
+        if name == "get" and not any(arg in request.args for arg in ("include", "as_of")) and not snapshot_read:
+            # the version stamp does not cover included neighbours, nor a (stale) snapshot, nor history
+            kwargs = {key: str(markupsafe.escape(value)) for key, value in kwargs.items() if value is not None}
+            try:
+                g.etag = cmdb_etag.etag(self, request, **kwargs)
+            except:
+                logging.exception("could not compute the ETag of %s", request.full_path)
+                g.etag = None
+            if g.etag is not None and request.if_none_match.contains(g.etag):
+                return check_auth(self) or cmdb_etag.not_modified(g.etag)
+
+    def after_request(self, name, response):
+        if request.method != "GET":
+            if name not in self.__read_only__:
+                cmdb_cache.invalidate_write(self, request)
+                cmdb_snapshot.changed()
+            return response
+
+        if getattr(g, "snapshot", None) is not None:
+            response.headers.extend(cmdb_snapshot.headers(g.snapshot))
+
+        if response.status_code == 200 and not response.is_streamed:
+            if getattr(g, "etag", None) is not None:
+                response.set_etag(g.etag)
+            else:
+                response.add_etag()
+        response = cmdb_cache.store(self, request, response, getattr(g, "cache_tags", ()))
+        return response.make_conditional(request)
+
+    def _write(self, verb, *args):
+        """
+        run a GRest verb and append its changes to the log in one transaction,
+        see cmdb_changes.transaction
+        """
+        with cmdb_changes.transaction():
+            # GRest 删除关系时会断开该名称下的所有关系, 先记下它们
+            removed = self._related_ids() if request.method == "DELETE" else None
+            response = make_response(verb(self, *args))
+            if response.status_code < 300:
+                cmdb_changes.append(self._changes(response, removed))
+        cmdb_changes.notify()
+        return response
+
+    def _related_ids(self):
+        """ ids of the nodes related through the secondary of the url, None on a node url """
+        args = request.view_args or {}
+        name = args.get("secondary_model_name")
+        target = self.__model__.get("secondary", {}).get(name)
+        if target is None:
+            return None
+        model = self.__model__["primary"]
+        rel = cmdb_graph.relation(model, name, target)
+        rows = cmdb_graph.query("MATCH (n:%s {%s: $primary_id}) MATCH %s RETURN m.%s AS id"
+                                % (model.__label__, self.__selection_field__["primary"], cmdb_graph.pattern(rel),
+                                   cmdb_graph.id_field(target)),
+                                {"primary_id": args.get("primary_id")})
+        return [row["id"] for row in rows]
+
+    @route("", methods=["POST"])
+    @route("/<primary_id>/<secondary_model_name>/<secondary_id>", methods=["POST"])
+    @authenticate
+    @authorize
+    def post(self, primary_id=None, secondary_model_name=None, secondary_id=None):
+        return self._write(post_verb, primary_id, secondary_model_name, secondary_id)
+
+    @route("/<primary_id>", methods=["PUT"])
+    @route("/<primary_id>/<secondary_model_name>/<secondary_id>", methods=["PUT"])
+    @authenticate
+    @authorize
+    def put(self, primary_id, secondary_model_name=None, secondary_id=None):
+        return self._write(put_verb, request, primary_id, secondary_model_name, secondary_id)
+
+    @route("/<primary_id>", methods=["PATCH"])
+    @authenticate
+    @authorize
+    def patch(self, primary_id):
+        return self._write(patch_verb, request, primary_id)
+
+    @route("/", methods=["DELETE"])
+    @route("/<primary_id>", methods=["DELETE"])
+    @route("/<primary_id>/<secondary_model_name>/<secondary_id>", methods=["DELETE"])
+    @authenticate
+    @authorize
+    def delete(self, primary_id=None, secondary_model_name=None, secondary_id=None):
+        if primary_id is None:
+            return self._write(delete_all_verb)
+        return self._write(delete_verb, primary_id, secondary_model_name, secondary_id)
+
+    def _changes(self, response, removed=None):
+        """ the change log entries of a successful GRest write, removed the ids a relationship DELETE disconnected """
+        args = request.view_args or {}
+        primary_id, secondary, secondary_id = args.get("primary_id"), args.get("secondary_model_name"), \
+            args.get("secondary_id")
+        data = request.get_json(silent=True)
+        resource = cmdb_changes.resource(self.__model__["primary"])
+
+        if secondary is not None:
+            if request.method == "DELETE":
+                return [cmdb_changes.change("disconnect", resource, primary_id, secondary, target_id)
+                        for target_id in removed or [secondary_id]]
+            op = {"POST": "connect", "PUT": "replace"}[request.method]
+            return [cmdb_changes.change(op, resource, primary_id, secondary, secondary_id, data)]
+        if request.method == "DELETE":
+            # DELETE /<resource> drops every node of the resource, id is null
+            return [cmdb_changes.change("delete", resource, primary_id)]
+
+        written = (response.get_json(silent=True) or {}).get(self.__selection_field__["primary"])
+        if request.method == "POST":
+            return [cmdb_changes.change("create", resource, written, data=data)]
+        if request.method == "PUT":
+            # GRest replaces the node: deleted with its relationships, created again (under a new id
+            # when the body has none)
+            return [cmdb_changes.change("delete", resource, primary_id),
+                    cmdb_changes.change("create", resource, written or primary_id, data=data)]
+        return [cmdb_changes.change("update", resource, primary_id, data=data)]
+
+    def _includes(self):
+        views = {view.__model__["primary"]: view for view in RESOURCES.values()}
+        return cmdb_projection.parse_includes(self, request.args.get("include"), views,
+                                              cmdb_projection.neighbour_fields(request.args))
+
+    @authenticate
+    @authorize
+    def index(self):
+        if not any(arg in request.args for arg in ("cursor", "fields", "include")):
+            return super(CMDBView, self).index()
+
+        model = self.__model__["primary"]
+        field = self.__selection_field__["primary"]
+        try:
+            fields = cmdb_projection.parse_fields(model, request.args.get("fields"))
+            includes = self._includes()
+            if "cursor" not in request.args:
+                skip = int_arg("skip", 0, 0, 2 ** 31)
+                limit = int_arg("limit", QUERY_LIMIT, 1, cmdb_paging.MAX_LIMIT)
+                return jsonify(cmdb_projection.nodes(model, fields, skip, limit,
+                                                     request.args.get("order_by"), includes)), 200
+
+            limit = int_arg("limit", cmdb_paging.DEFAULT_LIMIT, 1, cmdb_paging.MAX_LIMIT)
+            items, next_cursor = cmdb_paging.page(model, field, request.args["cursor"], limit, fields, includes)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        return jsonify(**{pluralize(model.__name__.lower()): items, "next_cursor": next_cursor}), 200
+
+    @route("/<primary_id>", methods=["GET"])
+    @route("/<primary_id>/<secondary_model_name>", methods=["GET"])
+    @route("/<primary_id>/<secondary_model_name>/<secondary_id>", methods=["GET"])
+    @authenticate
+    @authorize
+    def get(self, primary_id, secondary_model_name=None, secondary_id=None):
+        if "as_of" in request.args:
+            return self._as_of(primary_id, secondary_model_name, secondary_id)
+
+        if secondary_model_name is None:
+            value = request.args.get("fields")
+            if value is None and "include" not in request.args:
+                return super(CMDBView, self).get(primary_id)
+        else:
+            value = cmdb_projection.neighbour_fields(request.args).get(secondary_model_name,
+                                                                       request.args.get("fields"))
+            # neighbours are read from the in-memory snapshot when there is one
+            g.snapshot = cmdb_snapshot.fresh()
+            if value is None and g.snapshot is None:
+                return super(CMDBView, self).get(primary_id, secondary_model_name, secondary_id)
+
+        primary_id = str(markupsafe.escape(primary_id))
+        try:
+            if secondary_model_name is None:
+                fields = cmdb_projection.parse_fields(self.__model__["primary"], value)
+                document = cmdb_projection.node(self, primary_id, fields, self._includes())
+            else:
+                target = self.__model__.get("secondary", {}).get(secondary_model_name)
+                if target is None:
+                    return jsonify(errors=["Relation does not exist!"]), 404
+                fields = cmdb_projection.parse_fields(target, value)
+                document = cmdb_projection.related(self, primary_id, secondary_model_name, fields,
+                                                   secondary_id and str(markupsafe.escape(secondary_id)),
+                                                   g.snapshot)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        if document is None:
+            return jsonify(errors=["Selected %s does not exists!" % self.__model__["primary"].__name__]), 404
+        return jsonify(document), 200
+
+    def _as_of(self, primary_id, secondary_model_name=None, secondary_id=None):
+        """ GET routes with ?as_of=<ts>, read from the versions of cmdb_history """
+        try:
+            at = cmdb_history.parse_time(request.args["as_of"])
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+        if secondary_model_name is not None and secondary_model_name not in self.__model__.get("secondary", {}):
+            return jsonify(errors=["Relation does not exist!"]), 404
+
+        primary_id = str(markupsafe.escape(primary_id))
+        try:
+            if secondary_model_name is None:
+                document = cmdb_history.node_as_of(self, primary_id, at)
+            else:
+                document = cmdb_history.related_as_of(self, primary_id, secondary_model_name, at,
+                                                      secondary_id and str(markupsafe.escape(secondary_id)))
+        except:
+            logging.exception("history of %s %s failed", self.__model__["primary"].__name__, primary_id)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+        if document is None:
+            return jsonify(errors=["Selected %s does not exists!" % self.__model__["primary"].__name__]), 404
+        return jsonify(document), 200
+
+    @route("/<primary_id>/summary", methods=["GET"])
+    @authenticate
+    @authorize
+    def summary(self, primary_id):
+        try:
+            document = cmdb_projection.summary(self, str(markupsafe.escape(primary_id)))
+        except:
+            logging.exception("summary of %s %s failed", self.__model__["primary"].__name__, primary_id)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+        if document is None:
+            return jsonify(errors=["Selected %s does not exists!" % self.__model__["primary"].__name__]), 404
+        return jsonify(document), 200
+
+    @route("/export", methods=["GET"])
+    @authenticate
+    @authorize
+    def export(self):
+        gzip = bool_arg("gzip") or "gzip" in request.headers.get("Accept-Encoding", "")
+        try:
+            fields = cmdb_projection.parse_fields(self.__model__["primary"], request.args.get("fields"))
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        lines = cmdb_export.export_lines(self, relations=bool_arg("relations"), fields=fields)
+        response = Response(stream_with_context(cmdb_export.chunks(lines, gzip=gzip)),
+                            mimetype="application/x-ndjson")
+        if gzip:
+            response.headers["Content-Encoding"] = "gzip"
+        return response
+
+    @route("/by-<key>/<value>", methods=["GET"])
+    @authenticate
+    @authorize
+    def lookup(self, key, value):
+        if key not in self.__natural_keys__:
+            return jsonify(errors=["Selected key does not exists!"]), 404
+
+        model = self.__model__["primary"]
+        # a new node with that key has to drop the cached response
+        g.cache_tags = [cmdb_cache.label_tag(model)]
+        try:
+            fields = cmdb_projection.parse_fields(model, request.args.get("fields"))
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        try:
+            nodes = cmdb_lookup.lookup(self, key, [value], fields)[value]
+            if not nodes:
+                return jsonify(errors=["Selected %s does not exists!" % model.__name__]), 404
+            return jsonify(**{pluralize(model.__name__.lower()): nodes}), 200
+        except:
+            logging.exception("lookup of %s by %s failed", model.__name__, key)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+    @route("/by-<key>", methods=["POST"])
+    @authenticate
+    @authorize
+    def lookup_batch(self, key):
+        if key not in self.__natural_keys__:
+            return jsonify(errors=["Selected key does not exists!"]), 404
+
+        model = self.__model__["primary"]
+        try:
+            fields = cmdb_projection.parse_fields(model, request.args.get("fields"))
+            values = cmdb_lookup.read_keys(request)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        try:
+            results = cmdb_lookup.lookup(self, key, values, fields)
+            missing = [value for value, nodes in results.items() if not nodes]
+            return jsonify(results=results, missing=missing), 200
+        except:
+            logging.exception("batch lookup of %s by %s failed", model.__name__, key)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class AppView(CMDBView):
     """
     App view (/app)
     1. (App)-[USE]->(DevLanguage)
@@ -72,8 +458,32 @@ class AppView(GRest):
 
     }
 
+    __natural_keys__ = {
+        "name": ("app_name",)
+    }
+
+    """app 依赖的全部节点"""
+    @route("/<app_id>/dependencies", methods=["GET"])
+    @authenticate
+    @authorize
+    def dependencies(self, app_id):
+        try:
+            depth = int_arg("depth", cmdb_traversal.DEFAULT_DEPTH, 1, cmdb_traversal.MAX_DEPTH)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        g.snapshot = cmdb_snapshot.fresh()
+        try:
+            graph = cmdb_traversal.dependencies(str(markupsafe.escape(app_id)), depth, g.snapshot)
+            if graph is None:
+                return jsonify(errors=["Selected App does not exists!"]), 404
+            return jsonify(depth=depth, **graph), 200
+        except:
+            logging.exception("dependencies of app %s failed", app_id)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
 
-class DevLanguageView(GRest):
+
+class DevLanguageView(CMDBView):
     """
     dev language view (/devlanguage)
     1. (app)-[USE]->(DevLanguage)
@@ -93,7 +503,7 @@ class DevLanguageView(GRest):
     }
 
 
-class ServiceTypeView(GRest):
+class ServiceTypeView(CMDBView):
     """
     service type view (/servicetype)
     1. (app)-[USE]->(ServiceType)
@@ -113,7 +523,7 @@ class ServiceTypeView(GRest):
     }
 
 
-class ServletsEngineView(GRest):
+class ServletsEngineView(CMDBView):
     """
     servlets engine  view (/servletsengine)
     1. (app)-[USE]->(ServletsEngine)
@@ -133,7 +543,7 @@ class ServletsEngineView(GRest):
     }
 
 
-class ConfigTypeView(GRest):
+class ConfigTypeView(CMDBView):
     """
     config type view (/configtype)
     1. (app)-[USE]->(ConfigType)
@@ -153,7 +563,7 @@ class ConfigTypeView(GRest):
     }
 
 
-class HostView(GRest):
+class HostView(CMDBView):
     """
     Hosts View (/host)
     1. (host)-[Belong_TO]->(Environment)
@@ -183,8 +593,20 @@ class HostView(GRest):
         }
     }
 
+    __natural_keys__ = {
+        "ip": ("private_ip", "public_ip"),
+        "name": ("host_name",)
+    }
+
+    """主机故障影响的 db, md, app"""
+    @route("/<host_id>/impact", methods=["GET"])
+    @authenticate
+    @authorize
+    def impact(self, host_id):
+        return impact_response(Host, host_id)
+
 
-class EnvironmentView(GRest):
+class EnvironmentView(CMDBView):
     """
     Environment View (/environment)
     1. (App)-[Belong_TO]->(Environment)
@@ -224,8 +646,34 @@ class EnvironmentView(GRest):
         }
     }
 
+    """环境统计: 各类节点数量, app 按 run_status, host 按 OS 分组"""
+    @route("/stats", methods=["GET"])
+    @authenticate
+    @authorize
+    def all_stats(self):
+        g.cache_tags = [cmdb_cache.label_tag(model) for model in cmdb_stats.counted_models(self)]
+        try:
+            return jsonify(cmdb_stats.all_stats(self)), 200
+        except:
+            logging.exception("stats of the environments failed")
+            return jsonify(errors=["An error occurred while processing your request."]), 500
 
-class FileServerView(GRest):
+    @route("/<environment_id>/stats", methods=["GET"])
+    @authenticate
+    @authorize
+    def stats(self, environment_id):
+        g.cache_tags = [cmdb_cache.label_tag(model) for model in cmdb_stats.counted_models(self)]
+        try:
+            document = cmdb_stats.environment_stats(self, str(markupsafe.escape(environment_id)))
+            if document is None:
+                return jsonify(errors=["Selected Environment does not exists!"]), 404
+            return jsonify(document), 200
+        except:
+            logging.exception("stats of environment %s failed", environment_id)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class FileServerView(CMDBView):
     """
     FileServer View (/fileServer)
     1. (App)-[USE]->(FileServer)
@@ -249,7 +697,7 @@ class FileServerView(GRest):
     }
 
 
-class DatabaseConnectView(GRest):
+class DatabaseConnectView(CMDBView):
     """
     DatabaseConnect View (/databaseconnect)
     1. (App)-[USE]->(DatabaseConnect)
@@ -266,16 +714,16 @@ class DatabaseConnectView(GRest):
     }
 
     __selection_field__ = {
-        "primary": "dbconnect_id",
+        "primary": "databaseconnect_id",
         "secondary": {
-            "app:": "app_id",
+            "app": "app_id",
             "environment": "environment_id",
             "db": "db_id"
         }
     }
 
 
-class DBView(GRest):
+class DBView(CMDBView):
     """
     DBView View (/db)"
     1. (DatabaseConnect)-[Belong_TO]->(DB)
@@ -300,8 +748,15 @@ class DBView(GRest):
         }
     }
 
+    """db 故障影响的 databaseconnect, app"""
+    @route("/<db_id>/impact", methods=["GET"])
+    @authenticate
+    @authorize
+    def impact(self, db_id):
+        return impact_response(DB, db_id)
+
 
-class K8SNamespaceView(GRest):
+class K8SNamespaceView(CMDBView):
     """
     K8SNamespace View (/k8snamespace)
     1. (K8SNamespace)-[Belong_TO]->(Environment)
@@ -318,7 +773,7 @@ class K8SNamespaceView(GRest):
     }
 
     __selection_field__ = {
-        "primary": "k8sns_id",
+        "primary": "k8snamespace_id",
         "secondary": {
             "environment": "environment_id",
             "k8s": "k8s_id",
@@ -327,7 +782,7 @@ class K8SNamespaceView(GRest):
     }
 
 
-class PersonView(GRest):
+class PersonView(CMDBView):
     """
     Person View (/person)
     1. (person)-[Manage_TO]->(Environment)
@@ -351,6 +806,310 @@ class PersonView(GRest):
     }
 
 
+# route_base -> view, every view is registered under /v1/<route_base>
+RESOURCES = {
+    "app": AppView,
+    "host": HostView,
+    "environment": EnvironmentView,
+    "fileserver": FileServerView,
+    "databaseconnect": DatabaseConnectView,
+    "db": DBView,
+    "k8snamespace": K8SNamespaceView,
+    "person": PersonView,
+
+    # app 使用到的在"开发语言""服务框架""web引擎""配置类型"
+    "devlanguage": DevLanguageView,
+    "servicetype": ServiceTypeView,
+    "servletsengine": ServletsEngineView,
+    "configtype": ConfigTypeView
+}
+
+
+class BulkView(FlaskView):
+    """
+    Bulk View (/bulk)
+    POST /bulk/<resource> with a JSON array (or NDJSON stream) of nodes,
+    see cmdb_bulk for the item format
+    """
+
+    @route("/<resource>", methods=["POST"])
+    @authenticate
+    @authorize
+    def bulk_import(self, resource):
+        view = RESOURCES.get(str(markupsafe.escape(resource)))
+        if view is None:
+            return jsonify(errors=["Selected resource does not exists!"]), 404
+
+        try:
+            batch_size = int_arg("batch_size", cmdb_bulk.BATCH_SIZE, 1, cmdb_bulk.MAX_BATCH_SIZE)
+            items = cmdb_bulk.read_items(request)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        try:
+            results = cmdb_bulk.import_nodes(view, items, batch_size)
+            cmdb_snapshot.changed()
+            failed = sum(1 for result in results if "errors" in result)
+            return jsonify(results=results, total=len(results), failed=failed), 200
+        except:
+            logging.exception("bulk import of %s failed", resource)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class RelationshipView(FlaskView):
+    """
+    Relationship View (/relationships)
+    POST /relationships/batch with a JSON array (or NDJSON stream) of links to
+    connect, disconnect or replace, see cmdb_bulk for the item format
+    """
+
+    @route("/batch", methods=["POST"])
+    @authenticate
+    @authorize
+    def batch(self):
+        try:
+            batch_size = int_arg("batch_size", cmdb_bulk.BATCH_SIZE, 1, cmdb_bulk.MAX_BATCH_SIZE)
+            items = cmdb_bulk.read_items(request)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+
+        try:
+            results = cmdb_bulk.import_links(RESOURCES, items, batch_size)
+            cmdb_snapshot.changed()
+            failed = sum(1 for result in results if "errors" in result)
+            return jsonify(results=results, total=len(results), failed=failed), 200
+        except:
+            logging.exception("batch of relationships failed")
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class QueryView(FlaskView):
+    """
+    Query View (/query)
+    POST /query {"find": "app", "where": {...}, "related": [...], "fields": [...], "limit": 20}
+    nodes of a label filtered on their properties and on their neighbours, see cmdb_query
+    GET /query counters of the compiled query cache
+    """
+
+    @authenticate
+    @authorize
+    def index(self):
+        return jsonify(plans=cmdb_query.stats()), 200
+
+    @authenticate
+    @authorize
+    def post(self):
+        try:
+            return jsonify(cmdb_query.run(request.get_json(silent=True))), 200
+        except ValueError as e:
+            return jsonify(errors=[str(e)]), 422
+        except RecursionError:
+            # json 解析过深的文档
+            return jsonify(errors=["Query is nested too deep"]), 422
+        except:
+            logging.exception("query %s failed", request.get_data(as_text=True)[:1000])
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class SearchView(FlaskView):
+    """
+    Search View (/search)
+    GET /search?q=web01[&type=host,app][&limit=20] ranked results of every CI type,
+    see cmdb_search
+    """
+
+    @authenticate
+    @authorize
+    def index(self):
+        types = [name.strip().lower() for name in request.args.get("type", "").split(",") if name.strip()]
+        try:
+            limit = int_arg("limit", cmdb_search.DEFAULT_LIMIT, 1, cmdb_search.MAX_LIMIT)
+            results = cmdb_search.search(request.args.get("q", ""), types, limit)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+        except:
+            logging.exception("search of %s failed", request.args.get("q"))
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+        return jsonify(results=results), 200
+
+
+class ChangesView(FlaskView):
+    """
+    Changes View (/changes)
+    GET /changes?since=<seq>[&limit=][&resource=host,app][&wait=30] the writes after since,
+    as server-sent events with Accept: text/event-stream, see cmdb_changes
+    """
+
+    # 先认证, 匿名请求不占用流的名额
+    @authenticate
+    @authorize
+    def index(self):
+        resources = [name.strip().lower() for name in request.args.get("resource", "").split(",") if name.strip()]
+        if any(name not in RESOURCES for name in resources):
+            return jsonify(errors=["Selected resource does not exists!"]), 404
+
+        stream = request.accept_mimetypes.best == "text/event-stream"
+        try:
+            since = request.headers.get("Last-Event-ID") if stream else None
+            since = int(since or request.args.get("since") or cmdb_changes.head()[0])
+            limit = int_arg("limit", cmdb_changes.DEFAULT_LIMIT, 1, cmdb_changes.MAX_LIMIT)
+            timeout = int_arg("wait", 0, 0, cmdb_changes.MAX_WAIT)
+            if since < 0:
+                raise ValueError("since must be positive")
+            # 流开始前检查 since 是否已被清理
+            result = cmdb_changes.read(since, 1 if stream else limit, resources)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+        except cmdb_changes.Pruned:
+            return jsonify(errors=["Changes since %d were pruned, resync and start from now" % since]), 410
+        except:
+            logging.exception("changes since %s failed", request.args.get("since"))
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+        if stream:
+            if not cmdb_changes.acquire_stream():
+                response = jsonify(errors=["Too many change streams, retry later or long-poll"])
+                response.status_code = 503
+                response.headers["Retry-After"] = str(cmdb_changes.HEARTBEAT)
+                return response
+            response = Response(stream_with_context(cmdb_changes.events(since, resources)),
+                                mimetype="text/event-stream")
+            response.call_on_close(cmdb_changes.release_stream)
+            response.headers["Cache-Control"] = "no-cache"
+            response.headers["X-Accel-Buffering"] = "no"
+            return response
+
+        try:
+            # 没有空闲名额时不等待, 直接返回空结果, 客户端再次轮询
+            if not result["changes"] and timeout and cmdb_changes.acquire_stream():
+                try:
+                    result = cmdb_changes.wait(since, limit, resources, timeout)
+                finally:
+                    cmdb_changes.release_stream()
+        except cmdb_changes.Pruned:
+            return jsonify(errors=["Changes since %d were pruned, resync and start from now" % since]), 410
+        except:
+            logging.exception("changes since %s failed", since)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+        return jsonify(result), 200
+
+
+class DiffView(FlaskView):
+    """
+    Diff View (/diff)
+    GET /diff?from=<ts>[&to=<ts>][&resource=app,host] nodes and relationships added,
+    removed and changed between two instants (to defaults to now), see cmdb_history
+    """
+
+    @authenticate
+    @authorize
+    def index(self):
+        resources = [name.strip().lower() for name in request.args.get("resource", "").split(",") if name.strip()]
+        if any(name not in RESOURCES for name in resources):
+            return jsonify(errors=["Selected resource does not exists!"]), 404
+
+        try:
+            since = cmdb_history.parse_time(request.args["from"])
+            until = cmdb_history.parse_time(request.args["to"]) if "to" in request.args else \
+                int(time.time() * 1000)
+            if since > until:
+                raise ValueError("from is after to")
+            return jsonify(cmdb_history.diff(since, until, resources)), 200
+        except (KeyError, ValueError):
+            return jsonify(errors=["Validation failed!"]), 422
+        except cmdb_history.DiffTooLarge as e:
+            return jsonify(errors=[str(e)]), 422
+        except:
+            logging.exception("diff of %s failed", request.query_string)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class HealthView(FlaskView):
+    """
+    Health View (/health)
+    GET /health/consistency[?label=App][&check=missing][&limit=] report of the
+    consistency scanner (python cmdb_consistency.py run), see cmdb_consistency
+    """
+
+    @route("/consistency", methods=["GET"])
+    @authenticate
+    @authorize
+    def consistency(self):
+        label, check = request.args.get("label"), request.args.get("check")
+        try:
+            limit = int_arg("limit", cmdb_consistency.DEFAULT_LIMIT, 1, cmdb_consistency.MAX_LIMIT)
+        except ValueError:
+            return jsonify(errors=["Validation failed!"]), 422
+        if label and label.lower() not in RESOURCES:
+            return jsonify(errors=["Selected resource does not exists!"]), 404
+        if check and check not in cmdb_consistency.CHECKS:
+            return jsonify(errors=["check must be one of %s." % ", ".join(cmdb_consistency.CHECKS)]), 422
+
+        try:
+            return jsonify(cmdb_consistency.report(label, check, limit)), 200
+        except:
+            logging.exception("consistency report failed")
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+
+
+class TopologyView(FlaskView):
+    """
+    Topology View (/topology)
+    GET /topology?environment=<id>[&format=msgpack] the nodes and relationships of an
+    environment in one compact document, JSON or MessagePack (Accept: application/msgpack),
+    see cmdb_topology
+    """
+
+    # 认证在 If-None-Match 的 304 之前
+    @authenticate
+    @authorize
+    def index(self):
+        environment_id = request.args.get("environment")
+        if not environment_id:
+            return jsonify(errors=["Validation failed!"]), 422
+        best = request.accept_mimetypes.best_match(["application/json", "application/msgpack",
+                                                    "application/x-msgpack"], "application/json")
+        fmt = request.args.get("format") or ("json" if best == "application/json" else "msgpack")
+        if fmt not in cmdb_topology.FORMATS:
+            return jsonify(errors=["Validation failed!"]), 422
+        if fmt == "msgpack" and cmdb_topology.msgpack is None:
+            return jsonify(errors=["MessagePack is not available, install msgpack."]), 406
+
+        try:
+            topology = cmdb_topology.get(environment_id)
+        except:
+            logging.exception("topology of %s failed", environment_id)
+            return jsonify(errors=["An error occurred while processing your request."]), 500
+        if topology is None:
+            return jsonify(errors=["Selected Environment does not exists!"]), 404
+
+        tag = "%s-%s" % (topology.etag, fmt)
+        if request.if_none_match.contains(tag):
+            return cmdb_etag.not_modified(tag)
+        gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+        response = Response(topology.body(fmt, gzip), mimetype=cmdb_topology.MIMETYPES[fmt])
+        if gzip:
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept, Accept-Encoding"
+        response.set_etag(tag)
+        return response
+
+
+class CacheView(FlaskView):
+    """ Cache View (/cache), counters of the GET response cache """
+
+    @authenticate
+    @authorize
+    def index(self):
+        return jsonify(cmdb_cache.stats()), 200
+
+    @authenticate
+    @authorize
+    def delete(self):
+        cmdb_cache.backend.clear()
+        return jsonify(result="OK"), 200
+
+
 def cmdb_api():
     app = Flask(__name__, static_folder='apidocs/apidocs/static')
     CORS(app)
@@ -364,23 +1123,37 @@ def cmdb_api():
 
 
     neomodel.config.DATABASE_URL = global_config.DB_URL
-    neomodel.config.AUTO_INSTALL_LABELS = True
+    # 索引由 python cmdb_schema.py create 创建, 启动时只检查
+    neomodel.config.AUTO_INSTALL_LABELS = False
     neomodel.config.FORCE_TIMEZONE = True  # default False
+    neomodel.config.MAX_CONNECTION_POOL_SIZE = cmdb_config.BOLT_MAX_CONNECTION_POOL_SIZE
 
-    AppView.register(app, route_base="/app", trailing_slash=False, route_prefix="/v1")
-    HostView.register(app, route_base="/host", trailing_slash=False, route_prefix="/v1")
-    EnvironmentView.register(app, route_base="/environment", trailing_slash=False, route_prefix="/v1")
-    FileServerView.register(app, route_base="/fileserver", trailing_slash=False, route_prefix="/v1")
-    DatabaseConnectView.register(app, route_base="/databaseconnect", trailing_slash=False, route_prefix="/v1")
-    DBView.register(app, route_base="/db", trailing_slash=False, route_prefix="/v1")
-    K8SNamespaceView.register(app, route_base="/k8snamespace", trailing_slash=False, route_prefix="/v1")
-    PersonView.register(app, route_base="/person", trailing_slash=False, route_prefix="/v1")
+    # 请求耗时, cypher 查询次数/行数, 序列化耗时, 连接池 -> /metrics
+    cmdb_metrics.init_app(app)
+    # 慢查询日志, ?_profile=1 返回 cypher 语句和执行计划 (PROFILING)
+    cmdb_profile.init_app(app)
 
-    # app 使用到的在"开发语言""服务框架""web引擎""配置类型"
-    DevLanguageView.register(app, route_base="/devlanguage", trailing_slash=False, route_prefix="/v1")
-    ServiceTypeView.register(app, route_base="/servicetype", trailing_slash=False, route_prefix="/v1")
-    ServletsEngineView.register(app, route_base="/servletsengine", trailing_slash=False, route_prefix="/v1")
-    ConfigTypeView.register(app, route_base="/configtype", trailing_slash=False, route_prefix="/v1")
+    # 变更写入 change log 的同时记录历史版本 (HISTORY)
+    if cmdb_history.record not in cmdb_changes.OBSERVERS:
+        cmdb_changes.OBSERVERS.append(cmdb_history.record)
+
+    # 每个进程共用一个 Bolt driver (neomodel 默认每个线程一个)
+    app.before_request(cmdb_driver.use_shared_driver)
+
+    cmdb_schema.verify()
+
+    for route_base, view in RESOURCES.items():
+        view.register(app, route_base="/" + route_base, trailing_slash=False, route_prefix="/v1")
+
+    BulkView.register(app, route_base="/bulk", trailing_slash=False, route_prefix="/v1")
+    ChangesView.register(app, route_base="/changes", trailing_slash=False, route_prefix="/v1")
+    DiffView.register(app, route_base="/diff", trailing_slash=False, route_prefix="/v1")
+    HealthView.register(app, route_base="/health", trailing_slash=False, route_prefix="/v1")
+    TopologyView.register(app, route_base="/topology", trailing_slash=False, route_prefix="/v1")
+    CacheView.register(app, route_base="/cache", trailing_slash=False, route_prefix="/v1")
+    RelationshipView.register(app, route_base="/relationships", trailing_slash=False, route_prefix="/v1")
+    SearchView.register(app, route_base="/search", trailing_slash=False, route_prefix="/v1")
+    QueryView.register(app, route_base="/query", trailing_slash=False, route_prefix="/v1")
 
     return app
 
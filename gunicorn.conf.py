@@ -0,0 +1,24 @@
+#coding=utf-8
+"""
+gunicorn settings, see cmdb_config for the values and their overrides
+
+the app is imported once in the master (preload_app) and forked; each worker
+creates its own Bolt driver on its first request (cmdb_driver), which its
+threads share.
+"""
+
+import cmdb_config
+import cmdb_driver
+
+bind = cmdb_config.BIND
+workers = cmdb_config.WORKERS
+threads = cmdb_config.THREADS
+worker_class = "gthread"
+timeout = cmdb_config.TIMEOUT
+max_requests = cmdb_config.MAX_REQUESTS
+max_requests_jitter = cmdb_config.MAX_REQUESTS // 10
+preload_app = True
+
+
+def worker_exit(server, worker):
+    cmdb_driver.close()
@@ -0,0 +1,10 @@
+#coding=utf-8
+"""
+WSGI entry point for production, behind a pre-fork server:
+    gunicorn wsgi:application
+(gunicorn.conf.py reads workers, threads, bind ... from cmdb_config)
+"""
+
+from cmdb_view import cmdb_api
+
+application = cmdb_api()